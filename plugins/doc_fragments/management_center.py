@@ -53,6 +53,101 @@ options:
           - Full path to the log file
         type: str
         required: true
+  smc_cache:
+    description:
+      - Optionally cache the href of elements resolved by name in a file shared by all
+        tasks of a play. Each task otherwise repeats the same lookups against the SMC.
+        Entries are scoped to the SMC URL and domain and are dropped once stale.
+    required: false
+    type: dict
+    suboptions:
+      path:
+        description:
+          - Full path to the cache file. The file is safe to share between concurrent tasks
+        type: str
+        required: true
+      ttl:
+        description:
+          - Time in seconds an entry is considered valid
+        type: int
+        default: 3600
+  smc_session:
+    description:
+      - Optionally reuse the authenticated SMC session between tasks instead of logging in
+        and out in every task. The session cookie is saved in a private file keyed by
+        I(smc_address), I(smc_domain) and I(smc_api_key), which must be provided as
+        parameters. An expired session is re-authenticated automatically.
+    required: false
+    type: dict
+    suboptions:
+      path:
+        description:
+          - Full path to the session file. It is created readable by the owner only
+        type: str
+        required: true
+      idle_timeout:
+        description:
+          - Time in seconds after which an unused session is no longer reused and a new
+            login is made
+        type: int
+        default: 600
+  smc_connection_pool:
+    description:
+      - Optional connection pool and TCP settings of the SMC session. When not provided,
+        the smc-python defaults are used. Increase I(maxsize) when modules run many
+        requests so connections are kept open and reused instead of reconnecting.
+    required: false
+    type: dict
+    suboptions:
+      connections:
+        description:
+          - Number of host connection pools to cache
+        type: int
+        default: 10
+      maxsize:
+        description:
+          - Maximum number of connections kept open per host
+        type: int
+        default: 10
+      block:
+        description:
+          - Wait for a free connection instead of opening a new connection when all
+            I(maxsize) connections are in use
+        type: bool
+        default: false
+      keepalive:
+        description:
+          - Enable TCP keep alive on the SMC connections
+        type: bool
+        default: true
+      keepalive_idle:
+        description:
+          - Seconds a connection is idle before keep alive probes are sent. Only applied
+            on platforms supporting it
+        type: int
+      keepalive_interval:
+        description:
+          - Seconds between keep alive probes. Only applied on platforms supporting it
+        type: int
+      keepalive_count:
+        description:
+          - Number of unanswered keep alive probes before the connection is dropped. Only
+            applied on platforms supporting it
+        type: int
+      tcp_nodelay:
+        description:
+          - Disable Nagle's algorithm on the SMC connections
+        type: bool
+        default: true
+  smc_metrics:
+    description:
+      - Count and time the SMC REST calls made by the task. The summary is returned in
+        the task result as I(smc_metrics), with the number and duration of calls grouped
+        by method, entry point and status code and the wall time of the connect,
+        exec_module and disconnect phases
+    required: false
+    type: bool
+    default: false
   smc_extra_args:
     description: 
       - Extra arguments to pass to login constructor. These are generally only used if
@@ -32,6 +32,16 @@ options:
       - Whether to do a case sensitive match on the filter specified
     required: false
     default: true
+  page_size:
+    description:
+      - Number of results fetched from the SMC per request. Results are then processed
+        one page at a time and no further pages are fetched once I(limit) is reached,
+        which keeps memory usage constant on large inventories. Set to 0 to fetch the
+        results in a single request, only the first I(limit) results being requested
+        when a limit is set.
+    required: false
+    default: 0
+    type: int
 
 notes:
   - If a filter is not used in the query, this will return all results for the
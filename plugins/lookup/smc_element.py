@@ -5,6 +5,8 @@ from smc import session
 from smc.api.common import fetch_meta_by_name
 from ansible.errors import AnsibleError
 from ansible.plugins.lookup import LookupBase
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_util \
+    import ElementStore
 from smc.base.model import Element
 
 DOCUMENTATION = """
@@ -21,20 +23,44 @@ DOCUMENTATION = """
       _terms:
         description: The element name to look up
         required: True
+      cache_path:
+        description: Optional path of the element cache file shared with the modules
+          C(smc_cache) setting. The href is then only fetched once per I(cache_ttl).
+        required: False
+      cache_ttl:
+        description: Time in seconds a cached entry is considered valid
+        default: 3600
+        required: False
 """
 
 
 class LookupModule(LookupBase):
     def run(self, terms, variables=None, **kwargs):
+        store = None
         try:
             session.login()
             print("terms={}".format(terms))
+            if kwargs.get("cache_path"):
+                store = ElementStore(kwargs["cache_path"], int(kwargs.get("cache_ttl", 3600)),
+                                     scope="{}|{}".format(session.url, session.domain))
+                # Entries are checked with a conditional request on their
+                # etag, stale entries (deleted or renamed element) are dropped
+                element = store.get_valid_element("element", terms[0])
+                if element:
+                    return [element]
             found = fetch_meta_by_name(terms[0])
             print("found={}".format(found))
             if len(found.json) == 0:
                 raise AnsibleError("can't find element {}".format(terms))
             href = found.json[0].get("href")
             print("found={}".format(href))
-            return [Element.from_href(href)]
+            element = Element.from_href(href)
+            if store:
+                store.set("element", terms[0], element, element.etag)
+            return [element]
         except BaseException as e:
             raise AnsibleError("smc_element error: {}".format(e))
+        finally:
+            # Stale entries are dropped even when the element is not found
+            if store:
+                store.flush()
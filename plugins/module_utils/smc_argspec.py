@@ -0,0 +1,105 @@
+#
+# (c) 2017, Forcepoint
+# Precomputed `create` and `__init__` argspecs of the smc-python element
+# classes used by the type dicts in smc_util, keyed by smc-python version.
+# Each entry is module.class.method: (required_args, valid_args). Classes
+# or versions not listed are introspected at runtime.
+
+ARGSPECS = {
+    '1.0.31': {
+        'smc.core.engine.Engine.__init__': (
+            [],
+            ['name']),
+        'smc.elements.group.Group.create': (
+            ['name'],
+            ['name', 'members', 'comment', 'is_monitored']),
+        'smc.elements.group.ICMPServiceGroup.create': (
+            ['name'],
+            ['name', 'members', 'comment']),
+        'smc.elements.group.IPServiceGroup.create': (
+            ['name'],
+            ['name', 'members', 'comment']),
+        'smc.elements.group.ServiceGroup.create': (
+            ['name'],
+            ['name', 'members', 'comment']),
+        'smc.elements.group.TCPServiceGroup.create': (
+            ['name'],
+            ['name', 'members', 'comment']),
+        'smc.elements.group.UDPServiceGroup.create': (
+            ['name'],
+            ['name', 'members', 'comment']),
+        'smc.elements.netlink.StaticNetlink.create': (
+            ['name', 'gateway', 'network'],
+            ['name', 'gateway', 'network', 'connection_type', 'input_speed',
+             'output_speed', 'domain_server_address', 'provider_name',
+             'probe_address', 'standby_mode_period', 'standby_mode_timeout',
+             'active_mode_period', 'active_mode_timeout', 'ipv4_outbound',
+             'ipv6_outbound', 'comment']),
+        'smc.elements.network.AddressRange.create': (
+            ['name', 'ip_range'],
+            ['name', 'ip_range', 'comment']),
+        'smc.elements.network.Alias.__init__': (
+            [],
+            ['name']),
+        'smc.elements.network.Country.__init__': (
+            [],
+            ['name']),
+        'smc.elements.network.DomainName.create': (
+            ['name'],
+            ['name', 'domain_name_entry', 'comment']),
+        'smc.elements.network.Expression.__init__': (
+            [],
+            ['name']),
+        'smc.elements.network.Host.create': (
+            ['name'],
+            ['name', 'address', 'ipv6_address', 'secondary',
+             'third_party_monitoring', 'tools_profile_ref', 'comment']),
+        'smc.elements.network.IPList.create': (
+            ['name'],
+            ['name', 'iplist', 'comment']),
+        'smc.elements.network.Network.create': (
+            ['name'],
+            ['name', 'ipv4_network', 'ipv6_network', 'broadcast',
+             'location_ref', 'comment']),
+        'smc.elements.network.Router.create': (
+            ['name'],
+            ['name', 'address', 'ipv6_address', 'secondary',
+             'third_party_monitoring', 'tools_profile_ref', 'comment']),
+        'smc.elements.network.Zone.create': (
+            ['name'],
+            ['name', 'comment']),
+        'smc.elements.protocols.ProtocolAgent.__init__': (
+            [],
+            ['name']),
+        'smc.elements.service.ApplicationSituation.__init__': (
+            [],
+            ['name']),
+        'smc.elements.service.EthernetService.create': (
+            ['name'],
+            ['name', 'frame_type', 'value1', 'value2', 'protocol_agent_ref',
+             'comment']),
+        'smc.elements.service.ICMPIPv6Service.create': (
+            ['name', 'icmp_type'],
+            ['name', 'icmp_type', 'icmp_code', 'comment']),
+        'smc.elements.service.ICMPService.create': (
+            ['name', 'icmp_type'],
+            ['name', 'icmp_type', 'icmp_code', 'comment']),
+        'smc.elements.service.IPService.create': (
+            ['name', 'protocol_number'],
+            ['name', 'protocol_number', 'protocol_agent', 'comment']),
+        'smc.elements.service.RPCService.__init__': (
+            [],
+            ['name']),
+        'smc.elements.service.TCPService.create': (
+            ['name', 'min_dst_port'],
+            ['name', 'min_dst_port', 'max_dst_port', 'min_src_port',
+             'max_src_port', 'protocol_agent', 'comment']),
+        'smc.elements.service.UDPService.create': (
+            ['name', 'min_dst_port'],
+            ['name', 'min_dst_port', 'max_dst_port', 'min_src_port',
+             'max_src_port', 'protocol_agent', 'comment']),
+        'smc.elements.service.URLCategory.__init__': (
+            [],
+            ['name']),
+    }
+}
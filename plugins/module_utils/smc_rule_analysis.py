@@ -0,0 +1,740 @@
+#
+# (c) 2017, Forcepoint
+"""
+Static analysis helpers for policy rules. Rule cells are expanded into
+sets of integer intervals: IP addresses for source and destination cells
+and protocol/port values for service cells. Elements whose matching
+cannot be expanded statically (zones, aliases, domain names, expressions,
+applications..) are kept as opaque references, only equal to themselves.
+"""
+import ipaddress
+
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_util import \
+    RuleSnapshot, HrefResolver
+
+try:
+    from smc.base.model import Element
+    from smc.api.exceptions import SMCException
+except ImportError:
+    pass
+
+
+# IPv6 addresses are offset so they never overlap IPv4 addresses
+IPV6_OFFSET = 1 << 129
+
+# Services are encoded as protocol * PORT_SPACE + port. ICMP services use
+# type * 256 + code as port
+PORT_SPACE = 1 << 16
+
+TCP, UDP, ICMP, ICMPV6 = 6, 17, 1, 58
+
+protocols = {'icmp': ICMP, 'tcp': TCP, 'udp': UDP, 'icmpv6': ICMPV6}
+
+cells = ('sources', 'destinations', 'services')
+
+# Rules with these actions never decide the fate of a connection
+non_terminating = ('continue', 'jump')
+
+network_groups = ('group',)
+
+nat_types = ('dynamic_src_nat', 'static_src_nat', 'static_dst_nat')
+
+service_groups = ('service_group', 'tcp_service_group', 'udp_service_group',
+    'icmp_service_group', 'icmp_ipv6_service_group', 'ip_service_group')
+
+
+def rule_records(rules):
+    """
+    Fields of the rules used by the analysis, with cells as in the rule
+    json. The data of a rule is released once its record is built.
+
+    :param list rules: rules fetched from the policy
+    :return: generator of dict
+    """
+    for rule in rules:
+        data = rule.data
+        action = data.get('action', {}).get('action')
+        if isinstance(action, list):
+            action = action[0] if action else None
+        record = {
+            'name': rule.name,
+            'tag': data.get('tag'),
+            'is_disabled': data.get('is_disabled', False),
+            'action': action,
+            'sub_policy': data.get('action', {}).get('sub_policy'),
+            'require_auth': data.get('authentication_options', {}).get('require_auth', False),
+            'conditions': rule_conditions(data)}
+        if not rule.is_rule_section:
+            record.update({cell: data.get(cell) for cell in cells})
+            # NAT rules carry their translations in the rule options
+            options = data.get('options') or {}
+            nat = {nat_type: options[nat_type] for nat_type in nat_types
+                   if options.get(nat_type)}
+            if nat:
+                record['nat'] = nat
+            if 'used_on' in data:
+                record['used_on'] = data['used_on']
+        yield record
+        del rule.data
+
+
+def rule_conditions(data):
+    """
+    Match conditions of a rule other than its cells. A rule with match
+    conditions only matches part of the traffic of its cells, depending
+    on information not known offline.
+
+    :param dict data: rule json
+    :return: names of the match condition fields set on the rule
+    :rtype: list
+    """
+    conditions = []
+    vpn = data.get('match_vpn_options') or {}
+    if vpn.get('match_type') or vpn.get('match_vpns'):
+        conditions.append('match_vpn_options')
+    if data.get('rule_validity_times'):
+        conditions.append('rule_validity_times')
+    return conditions
+
+
+def policy_records(collection, snapshot=None):
+    """
+    Records of the rules of a rule collection, in policy order. When a
+    snapshot path is given, only new and changed rules are fetched.
+
+    :param rule_collection collection: rules of a policy, for example
+        `policy.fw_ipv4_access_rules`
+    :param str snapshot: path of the snapshot file
+    :rtype: list
+    """
+    rule_type = collection.cls.typeof
+    rules = [rule for rule in collection if rule.typeof == rule_type]
+    if snapshot:
+        return RuleSnapshot(snapshot, collection, variant='analysis.conditions').refresh(
+            rules, rule_records)
+    return list(rule_records(rules))
+
+
+def nat_translation(nat):
+    """
+    Normalised translations of a NAT rule record. Each NAT type maps to
+    its translated values, an element being compared by href only.
+    Ports are returned as (min, max) tuples when set.
+
+    :param dict nat: NAT options of the rule record
+    :rtype: dict
+    """
+    translation = {}
+    for nat_type in nat_types:
+        options = nat.get(nat_type) or {}
+        if nat_type == 'dynamic_src_nat':
+            values = options.get('translation_values') or []
+        else:
+            values = [options['translated_value']] if options.get('translated_value') else []
+        normalised = []
+        for value in values:
+            entry = {'element': value['element']} if value.get('element') else \
+                {'ip_descriptor': value.get('ip_descriptor')}
+            ports = nat_ports(value)
+            if ports:
+                entry['ports'] = ports
+            normalised.append(entry)
+        if normalised:
+            translation[nat_type] = normalised
+            original = options.get('original_value') or {}
+            if nat_type == 'static_dst_nat' and nat_ports(original):
+                translation['static_dst_nat_original_ports'] = nat_ports(original)
+    return translation
+
+
+def nat_ports(value):
+    """
+    Port range of a NAT value, or None when no port is set
+
+    :param dict value: original or translated NAT value
+    :rtype: tuple
+    """
+    first, last = value.get('min_port'), value.get('max_port')
+    if first in (None, ''):
+        return None
+    last = first if last in (None, '') else last
+    return (int(first), int(last))
+
+
+def reference(rule):
+    return {key: rule[key] for key in ('pos', 'name', 'tag', 'action')}
+
+
+def address_interval(value):
+    """
+    Interval of an address, network in CIDR notation or address range
+    in format 'first-last'
+
+    :param str value: address, network or range
+    :rtype: tuple
+    """
+    value = value.strip()
+    if '-' in value:
+        first, last = value.split('-', 1)
+        first, last = ipaddress.ip_address(first.strip()), ipaddress.ip_address(last.strip())
+    elif '/' in value:
+        network = ipaddress.ip_network(value, strict=False)
+        first, last = network.network_address, network.broadcast_address
+    else:
+        first = last = ipaddress.ip_address(value)
+    offset = IPV6_OFFSET if first.version == 6 else 0
+    return (int(first) + offset, int(last) + offset)
+
+
+def port_interval(protocol, first=0, last=PORT_SPACE - 1):
+    """
+    Interval of a port range of a protocol
+
+    :rtype: tuple
+    """
+    return (protocol * PORT_SPACE + first, protocol * PORT_SPACE + last)
+
+
+def connection_values(connection):
+    """
+    Source, destination and service values of a connection, in the form
+    of the expanded rule cells
+
+    :param dict connection: connection as specified in the module
+    :raises ValueError: invalid connection
+    :rtype: tuple
+    """
+    protocol = str(connection.get('protocol') or 'tcp').lower()
+    protocol = protocols[protocol] if protocol in protocols else int(protocol)
+    if protocol in (ICMP, ICMPV6):
+        port = int(connection.get('icmp_type') or 0) * 256 + \
+            int(connection.get('icmp_code') or 0)
+    elif protocol in (TCP, UDP):
+        if connection.get('dst_port') is None:
+            raise ValueError('dst_port is required for tcp and udp')
+        port = int(connection['dst_port'])
+    else:
+        port = int(connection.get('dst_port') or 0)
+    if not 0 <= port < PORT_SPACE:
+        raise ValueError('Port is out of range: %s' % port)
+    return (host_value(connection['src']),
+            host_value(connection['dst']),
+            protocol * PORT_SPACE + port)
+
+
+def host_value(value):
+    """
+    Value of a single host address, networks and ranges are rejected
+
+    :param str value: IPv4 or IPv6 address
+    :raises ValueError: not a host address
+    :rtype: int
+    """
+    address = ipaddress.ip_address(u'%s' % str(value).strip())
+    return int(address) + (IPV6_OFFSET if address.version == 6 else 0)
+
+
+def merge_intervals(intervals):
+    """
+    Sort and merge overlapping or adjacent intervals
+
+    :param list intervals: (first, last) tuples
+    :rtype: list
+    """
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def intervals_cover(outer, inner):
+    """
+    Whether the merged intervals of outer contain all inner intervals
+
+    :rtype: bool
+    """
+    index = 0
+    for first, last in inner:
+        while index < len(outer) and outer[index][1] < first:
+            index += 1
+        if index == len(outer) or outer[index][0] > first or outer[index][1] < last:
+            return False
+    return True
+
+
+def intervals_overlap(left, right):
+    """
+    Whether two lists of merged intervals have a common value
+
+    :rtype: bool
+    """
+    i = j = 0
+    while i < len(left) and j < len(right):
+        if left[i][1] < right[j][0]:
+            i += 1
+        elif right[j][1] < left[i][0]:
+            j += 1
+        else:
+            return True
+    return False
+
+
+class Cell(object):
+    """
+    Values matched by a rule cell. A cell matches any value, no value,
+    or the union of its intervals and opaque references.
+
+    :param bool any: cell matches any value
+    :param list intervals: (first, last) tuples
+    :param opaque: hrefs of the elements that could not be expanded
+    """
+
+    __slots__ = ('any', 'intervals', 'opaque')
+
+    def __init__(self, any=False, intervals=None, opaque=None):  # @ReservedAssignment
+        self.any = any
+        self.intervals = merge_intervals(intervals or [])
+        self.opaque = frozenset(opaque or ())
+
+    @property
+    def is_none(self):
+        return not self.any and not self.intervals and not self.opaque
+
+    def covers(self, other):
+        """
+        Whether every value matched by the other cell is matched by
+        this cell
+
+        :rtype: bool
+        """
+        if self.any:
+            return True
+        if other.any:
+            return False
+        return other.opaque <= self.opaque and \
+            intervals_cover(self.intervals, other.intervals)
+
+    def overlaps(self, other):
+        """
+        Whether a value is known to be matched by both cells
+
+        :rtype: bool
+        """
+        if self.is_none or other.is_none:
+            return False
+        if self.any or other.any:
+            return True
+        return bool(self.opaque & other.opaque) or \
+            intervals_overlap(self.intervals, other.intervals)
+
+    def __repr__(self):
+        return 'Cell(any=%s, intervals=%s, opaque=%s)' % (
+            self.any, self.intervals, sorted(self.opaque))
+
+
+def _zones_only(cell):
+    # Interfaces belong to a single zone, so distinct zones never overlap
+    return not cell.intervals and all(
+        HrefResolver.typeof(href) == 'interface_zone' for href in cell.opaque)
+
+
+def cells_disjoint(cell, other):
+    """
+    Whether no value can be matched by both cells. Unlike `Cell.overlaps`,
+    opaque elements are assumed to possibly match any value, except zones
+    which only overlap themselves.
+
+    :rtype: bool
+    """
+    if cell.is_none or other.is_none:
+        return True
+    if cell.any or other.any:
+        return False
+    if cell.opaque or other.opaque:
+        return _zones_only(cell) and _zones_only(other) and \
+            not cell.opaque & other.opaque
+    return not intervals_overlap(cell.intervals, other.intervals)
+
+
+def spaces_disjoint(space, other):
+    """
+    Whether two rules can never match the same connection, their order
+    in the policy then being irrelevant
+
+    :param tuple space: Cell of each cell of a rule
+    :param tuple other: Cell of each cell of the other rule
+    :rtype: bool
+    """
+    return any(cells_disjoint(cell, other_cell)
+               for cell, other_cell in zip(space, other))
+
+
+class ElementRanges(object):
+    """
+    Run wide memo of the intervals matched by elements, by href. Each
+    element is loaded once, group members are expanded recursively.
+    Elements that can not be expanded, or can not be loaded, are kept as
+    opaque references.
+    """
+
+    def __init__(self):
+        self._ranges = {} # href: (intervals, opaque)
+
+    def add(self, href, intervals, opaque=None):
+        """
+        Set the ranges of an element not loaded from the SMC, for
+        example an element planned to be created
+
+        :param str href: reference of the element
+        :param list intervals: (first, last) tuples
+        :param opaque: hrefs of the elements that could not be expanded
+        """
+        self._ranges[href] = (list(intervals), set(opaque or ()))
+
+    def cell(self, value):
+        """
+        Expand a rule cell, as found in the rule json, for example
+        {'src': [href1, href2]}, {'any': True} or {'none': True}
+
+        :param dict value: rule cell
+        :rtype: Cell
+        """
+        value = value or {}
+        if value.get('any'):
+            return Cell(any=True)
+        intervals, opaque = [], set()
+        for key, hrefs in value.items():
+            if key in ('any', 'none') or not isinstance(hrefs, list):
+                continue
+            for href in hrefs:
+                _intervals, _opaque = self.ranges(href)
+                intervals.extend(_intervals)
+                opaque.update(_opaque)
+        return Cell(intervals=intervals, opaque=opaque)
+
+    def ranges(self, href, _seen=None):
+        """
+        Intervals and opaque references matched by an element
+
+        :param str href: element href
+        :return: (intervals, opaque)
+        :rtype: tuple
+        """
+        if href in self._ranges:
+            return self._ranges[href]
+        seen = _seen or set()
+        if href in seen:
+            return ([], set())
+        seen.add(href)
+
+        try:
+            element = Element.from_href(href)
+            typeof, data = element.typeof, element.data
+        except SMCException:
+            typeof, data = None, {}
+
+        intervals, opaque = [], set()
+        if typeof in network_groups or typeof in service_groups:
+            for member in data.get('element', []):
+                _intervals, _opaque = self.ranges(member, seen)
+                intervals.extend(_intervals)
+                opaque.update(_opaque)
+        else:
+            try:
+                intervals = self.element_intervals(typeof, data)
+            except (KeyError, TypeError, ValueError):
+                intervals = None
+            if intervals is None:
+                intervals, opaque = [], set([href])
+
+        self._ranges[href] = (intervals, opaque)
+        return self._ranges[href]
+
+    @staticmethod
+    def element_intervals(typeof, data):
+        """
+        Intervals matched by a network or service element
+
+        :param str typeof: element type
+        :param dict data: element json
+        :return: list of intervals or None if the element can not be
+            expanded
+        :rtype: list
+        """
+        if typeof in ('host', 'router'):
+            addresses = [data.get('address'), data.get('ipv6_address')] + \
+                list(data.get('secondary') or [])
+            return [address_interval(address) for address in addresses if address]
+        elif typeof == 'network':
+            return [address_interval(network) for network in
+                    (data.get('ipv4_network'), data.get('ipv6_network')) if network]
+        elif typeof == 'address_range':
+            return [address_interval(data['ip_range'])]
+        elif typeof in ('tcp_service', 'udp_service'):
+            # Source port restrictions are not expanded
+            if data.get('min_src_port') not in (None, ''):
+                return None
+            protocol = TCP if typeof == 'tcp_service' else UDP
+            first = data.get('min_dst_port')
+            if first in (None, ''):
+                return [port_interval(protocol)]
+            last = data.get('max_dst_port')
+            last = first if last in (None, '') else last
+            return [port_interval(protocol, int(first), int(last))]
+        elif typeof == 'ip_service':
+            return [port_interval(int(data['protocol_number']))]
+        elif typeof in ('icmp_service', 'icmp_ipv6_service'):
+            protocol = ICMP if typeof == 'icmp_service' else ICMPV6
+            icmp_type = data.get('icmp_type')
+            if icmp_type in (None, ''):
+                return [port_interval(protocol)]
+            code = data.get('icmp_code')
+            if code in (None, ''):
+                return [port_interval(protocol, int(icmp_type) * 256, int(icmp_type) * 256 + 255)]
+            value = int(icmp_type) * 256 + int(code)
+            return [port_interval(protocol, value, value)]
+
+
+class IntervalTree(object):
+    """
+    Static centered interval tree. Finds the intervals overlapping a
+    range in O(log n + k) for k results.
+
+    :param list intervals: (first, last, value) tuples
+    """
+
+    def __init__(self, intervals):
+        self._root = self._build(list(intervals))
+
+    def _build(self, intervals):
+        if not intervals:
+            return None
+        starts = sorted(first for first, _last, _value in intervals)
+        center = starts[len(starts) // 2]
+        left, right, here = [], [], []
+        for interval in intervals:
+            if interval[1] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        return (center,
+                sorted(here, key=lambda interval: interval[0]),
+                sorted(here, key=lambda interval: -interval[1]),
+                self._build(left),
+                self._build(right))
+
+    def overlap(self, first, last):
+        """
+        Values of the intervals overlapping the range first-last
+
+        :rtype: list
+        """
+        result = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            center, by_first, by_last, left, right = node
+            if last < center:
+                for interval in by_first:
+                    if interval[0] > last:
+                        break
+                    result.append(interval[2])
+                stack.append(left)
+            elif first > center:
+                for interval in by_last:
+                    if interval[1] < first:
+                        break
+                    result.append(interval[2])
+                stack.append(right)
+            else:
+                result.extend(interval[2] for interval in by_first)
+                stack.append(left)
+                stack.append(right)
+        return result
+
+    def stab(self, point):
+        """
+        Values of the intervals containing the point
+
+        :rtype: list
+        """
+        return self.overlap(point, point)
+
+
+class CellIndex(object):
+    """
+    Index of the cells of many rules for one dimension. Returns the rules
+    whose cell may cover, or overlap, a given cell without comparing it
+    to every rule.
+
+    :param list cells: (key, Cell) tuples, key identifying the rule
+    """
+
+    def __init__(self, cells):
+        self.any = set()
+        self.opaque = {} # href: set of keys
+        intervals = []
+        for key, cell in cells:
+            if cell.any:
+                self.any.add(key)
+                continue
+            for first, last in cell.intervals:
+                intervals.append((first, last, key))
+            for href in cell.opaque:
+                self.opaque.setdefault(href, set()).add(key)
+        self.tree = IntervalTree(intervals)
+
+    def covering(self, cell):
+        """
+        Keys of the cells that may cover the cell. Every cell covering
+        it is returned, other cells may be returned as well.
+
+        :rtype: set
+        """
+        if cell.any:
+            return set(self.any)
+        if cell.is_none:
+            return set()
+        if cell.intervals:
+            keys = set(self.tree.stab(cell.intervals[0][0]))
+        else:
+            keys = set(self.opaque.get(next(iter(cell.opaque)), ()))
+        return keys | self.any
+
+    def overlapping(self, cell):
+        """
+        Keys of the cells that may overlap the cell, or None if the cell
+        matches any value
+
+        :rtype: set or None
+        """
+        if cell.any:
+            return None
+        keys = set(self.any)
+        for first, last in cell.intervals:
+            keys.update(self.tree.overlap(first, last))
+        for href in cell.opaque:
+            keys.update(self.opaque.get(href, ()))
+        return keys
+
+
+def overlapping_keys(indexes, space):
+    """
+    Keys of the rules whose cells may overlap every cell of the space,
+    one index per cell. The candidates of the most selective cell are
+    filtered by the other cells, so the keys of cells matching any value
+    are not copied for each lookup.
+
+    :param list indexes: CellIndex of each cell
+    :param tuple space: Cell of each cell
+    :return: keys, or None if every cell of the space matches any value
+    :rtype: set or None
+    """
+    dims = []
+    for index, cell in zip(indexes, space):
+        if cell.any:
+            continue
+        keys = set()
+        for first, last in cell.intervals:
+            keys.update(index.tree.overlap(first, last))
+        for href in cell.opaque:
+            keys.update(index.opaque.get(href, ()))
+        dims.append((len(keys) + len(index.any), keys, index.any))
+    if not dims:
+        return None
+    dims.sort(key=lambda dim: dim[0])
+    candidates = dims[0][1] | dims[0][2]
+    for _size, keys, any_keys in dims[1:]:
+        candidates = set(key for key in candidates if key in keys or key in any_keys)
+    return candidates
+
+
+def lowest_bits(bits):
+    """
+    Positions of the set bits, lowest first
+
+    :param int bits: bitset
+    :return: generator of int
+    """
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+class RuleTable(object):
+    """
+    Rules of a policy compiled for lookups. Each cell dimension is
+    indexed with an interval tree over the expanded cells. A lookup stabs
+    each tree with the value of the connection, turning the matching
+    rules into a bitset, and the first matching rule is the lowest bit
+    of the intersection of the dimensions.
+
+    Disabled rules, rule sections and continue rules are not compiled.
+    Rules requiring authentication or with other match conditions, or
+    whose cell contains an element that can not be expanded, may match
+    depending on information not known offline and are returned as
+    undetermined.
+
+    :param list records: rule records in policy order
+    :param ElementRanges ranges: expands cells into ranges
+    """
+
+    def __init__(self, records, ranges):
+        self.rules = []
+        for pos, record in enumerate(records, 1):
+            if record.get('is_disabled') or record.get('action') == 'continue' or \
+                    not all(record.get(cell) for cell in cells):
+                continue
+            space = tuple(ranges.cell(record[cell]) for cell in cells)
+            if any(cell.is_none for cell in space):
+                continue
+            self.rules.append(dict(
+                pos=pos,
+                name=record['name'],
+                tag=record['tag'],
+                action=record['action'],
+                sub_policy=record.get('sub_policy'),
+                require_auth=record.get('require_auth', False),
+                conditions=record.get('conditions') or [],
+                space=space))
+
+        self.indexes = [CellIndex((num, rule['space'][dim]) for num, rule in enumerate(self.rules))
+                        for dim in range(len(cells))]
+        self.any = [self.mask(index.any) for index in self.indexes]
+        self.opaque = [self.mask(key for keys in index.opaque.values() for key in keys)
+                       for index in self.indexes]
+        self.undetermined = self.mask(
+            num for num, rule in enumerate(self.rules)
+            if rule['require_auth'] or rule['conditions'])
+
+    @staticmethod
+    def mask(keys):
+        bits = 0
+        for key in keys:
+            bits |= 1 << key
+        return bits
+
+    def lookup(self, values):
+        """
+        Rules matching a connection
+
+        :param tuple values: source, destination and service value
+        :return: bitsets of the rules that match, and of the rules that
+            may match
+        :rtype: tuple
+        """
+        match = possible = (1 << len(self.rules)) - 1
+        for dim, value in enumerate(values):
+            bits = self.mask(self.indexes[dim].tree.stab(value)) | self.any[dim]
+            match &= bits
+            possible &= bits | self.opaque[dim]
+        return match & ~self.undetermined, possible
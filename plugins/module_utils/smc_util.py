@@ -3,11 +3,26 @@ Base spec for Forcepoint NGFW Management Center connections. This is a session
 that will be re-used for multiple operations against the management
 server.
 """
+import bisect
+import fcntl
+import functools
+import hashlib
 import inspect
+import itertools
+import json
 import logging
+import os
+import re
+import socket
+import ssl
+import tempfile
+import time
 import traceback
 
-from smc.administration.system import System
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
 
 try:
     from packaging.version import Version as StrictVersion
@@ -18,16 +33,26 @@ except ImportError:
         raise ImportError("Neither 'packaging' nor 'distutils' modules are available. "
                           "Please install 'packaging'.") from e
 
+try:
+    import yaml
+    HAS_YAML = True
+except ImportError:
+    HAS_YAML = False
+
 try:
     from ansible.module_utils.basic import AnsibleModule
     HAS_ANSIBLE = True
 except ImportError:
     HAS_ANSIBLE = False
 
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_argspec import ARGSPECS
+
 
 try:
-    from smc import session, set_file_logger
-    from smc.base.model import lookup_class
+    from smc import session, set_file_logger, __version__ as smc_version
+    from smc.base.model import lookup_class, Element, ElementCreator, \
+        ElementCache, prepared_request
+    from smc.base.util import element_resolver
     import smc.elements.network as network
     import smc.elements.netlink as netlink
     import smc.elements.group as group
@@ -38,8 +63,15 @@ try:
     from smc.elements.other import Category
     from smc.api.exceptions import ConfigLoadError, SMCException, \
         UserElementNotFound, ElementNotFound, DeleteElementFailed, \
-        UnsupportedEntryPoint
+        UnsupportedEntryPoint, CreateRuleFailed, FetchElementFailed
     from smc.elements.common import ThirdPartyMonitoring
+    from smc.administration.system import System
+    import smc.api.session as smc_session
+    from smc.api.session import SSLAdapter, load_entry_points
+    from smc.api.configloader import load_from_file, load_from_environ
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3 import Retry, PoolManager
     HAS_LIB = True
 except ImportError:
     HAS_LIB = False
@@ -47,6 +79,698 @@ except ImportError:
 logger = logging.getLogger("smc")
 
 
+def iter_pages(collection, page_size=500):
+    """
+    Iterate an ElementCollection one server side page at a time so that
+    callers can stop consuming results early without listing the entire
+    entry point. If the server does not honour paging and returns more
+    than a page of results, the results are consumed as a single page.
+
+    :param ElementCollection collection: search to iterate
+    :param int page_size: number of records requested per page. A value
+        of 0 disables paging
+    :return: generator of elements
+    """
+    if not page_size:
+        for element in collection:
+            yield element
+        return
+
+    start = 0
+    while True:
+        page = list(collection.between(start, start + page_size))
+        for element in page:
+            yield element
+        if len(page) != page_size:
+            return
+        start += page_size
+
+
+def iter_wanted(collection, wanted, key, page_size=500):
+    """
+    Find wanted elements by listing a collection in pages. Listing stops
+    once all elements are found, or as soon as the pages read outnumber
+    the elements still wanted, at which point loading the rest one at a
+    time costs fewer requests than listing on. Elements found are removed
+    from `wanted`, which then holds the elements left to load.
+
+    :param ElementCollection collection: search to iterate
+    :param set wanted: keys of the wanted elements
+    :param key: function returning the key of an element, for example
+        its name or href
+    :param int page_size: number of records requested per page
+    :return: generator of the wanted elements found
+    """
+    for num, element in enumerate(iter_pages(collection, page_size), 1):
+        if key(element) in wanted:
+            wanted.discard(key(element))
+            yield element
+            if not wanted:
+                return
+        if page_size and num % page_size == 0 and num // page_size >= len(wanted):
+            return
+
+
+def iter_rule_range(collection, start, end, page_size=0):
+    """
+    Iterate the rules of a rule collection within a range of positions.
+    Only the rules in the range are requested, using the start and end
+    parameters of the rule listing, in pages of page_size rules or in a
+    single request without a page size. Rules are returned with their
+    metadata only. If the server does not honour paging and returns the
+    full listing, the range is sliced from that listing.
+
+    :param rule_collection collection: rules of a policy, for example
+        `policy.fw_ipv4_access_rules`
+    :param int start: position of the first rule, starting at 1
+    :param int end: position of the last rule, included
+    :param int page_size: number of rules requested per page
+    :return: generator of rules
+    """
+    def listing(first, last):
+        return prepared_request(
+            FetchElementFailed,
+            href=collection.href,
+            params={'start': first, 'end': last}).read().json or []
+
+    offset = start - 1
+    first = None
+    if offset > 0:
+        # The listing does not return rule positions, so paging support is
+        # probed by requesting the first rule only. A server ignoring the
+        # parameters returns the full listing, and the range is sliced
+        page = listing(0, 1)
+        if len(page) > 1:
+            for meta in page[offset:end]:
+                yield collection.cls(**meta)
+            return
+        first = page[0] if page else None
+
+    while offset < end:
+        count = min(page_size or end - offset, end - offset)
+        page = listing(offset, offset + count)
+        if len(page) > count or (page and page[0] == first):
+            # Full listing returned
+            for meta in page[offset:end]:
+                yield collection.cls(**meta)
+            return
+        for meta in page:
+            yield collection.cls(**meta)
+        if len(page) != count:
+            return
+        offset += count
+
+
+def fingerprint(value):
+    """
+    Stable hash of a JSON compatible value. Dict keys are sorted so
+    equal values always have the same fingerprint.
+
+    :param value: value to hash, for example a normalised rule
+    :rtype: str
+    """
+    return hashlib.sha256(json.dumps(
+        value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def normalise_cell(value):
+    """
+    Normalised source, destination or service cell of a rule, used to
+    fingerprint rules. The cell is either the rule json cell, or the
+    cell value of the rule create constructor args.
+
+    :param value: rule json cell, 'any', None or list of elements or hrefs
+    :return: 'any', 'none' or sorted list of hrefs
+    :rtype: str or list
+    """
+    if isinstance(value, dict):
+        if value.get('any'):
+            return 'any'
+        if 'none' in value:
+            return 'none'
+        return sorted(set(href for hrefs in value.values() if isinstance(hrefs, list)
+                          for href in hrefs))
+    if not value:
+        return 'none'
+    if isinstance(value, str):
+        return 'any'
+    return sorted(set(element_resolver(value, do_raise=False)))
+
+
+def read_json_file(path):
+    """
+    Read a dict from a JSON file. A missing or unreadable file is
+    returned as an empty dict.
+
+    :rtype: dict
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def update_json_file(path, update, mode=0o600):
+    """
+    Read-modify-write a dict stored in a JSON file, safe for concurrent
+    writers. The update runs while holding an exclusive lock on a
+    companion lock file and the result is written to a temporary file
+    that atomically replaces the original, so readers never see a
+    partial file.
+
+    :param str path: path of the JSON file
+    :param callable update: called with the current dict to modify in place
+    :param int mode: file mode of the JSON file
+    :return: the dict as written
+    :rtype: dict
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            data = read_json_file(path)
+            update(data)
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.chmod(tmp, mode)
+            os.replace(tmp, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return data
+
+
+class RecordWriter(object):
+    """
+    Write records one at a time to a file, so large results can be
+    exported without being held in memory. Records are written as JSON
+    lines, or as the items of a YAML list. The file is written to a
+    temporary file that replaces the target once all records are
+    written, so a failed run does not leave a partial export.
+
+    Use as a context manager::
+
+        with RecordWriter('rules.jsonl') as writer:
+            for record in records:
+                writer.write(record)
+
+    :param str path: path of the file to write
+    :param str fmt: jsonl or yaml
+    """
+
+    def __init__(self, path, fmt='jsonl'):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.fmt = fmt
+        self.count = 0
+        self._file = None
+        self._tmp = None
+
+    def __enter__(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, self._tmp = tempfile.mkstemp(dir=directory)
+        self._file = os.fdopen(fd, 'w')
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.fmt == 'yaml' and not self.count:
+            self._file.write('[]\n')
+        self._file.close()
+        if exc_type is None:
+            os.chmod(self._tmp, 0o644)
+            os.replace(self._tmp, self.path)
+        else:
+            os.remove(self._tmp)
+
+    def write(self, record):
+        """
+        Write a record
+
+        :param dict record: JSON compatible record
+        """
+        # Round trip through json so dict subclasses are plain dicts
+        line = json.dumps(record, default=str)
+        if self.fmt == 'yaml':
+            self._file.write(yaml.safe_dump(
+                [json.loads(line)], default_flow_style=False))
+        else:
+            self._file.write(line + '\n')
+        self.count += 1
+
+
+def iter_yaml(rules, to_yaml, typeof, expand=None, chunk_size=500):
+    """
+    Serialise the rules of type `typeof` with `to_yaml`, a chunk of rules
+    at a time. Expanded elements of a chunk are resolved together and
+    remembered for the next chunks. The data of a rule is released once
+    serialised so rules can be streamed from large policies.
+
+    :param rules: iterable of rules
+    :param to_yaml: function serialising a rule, called with the rule, the
+        expanded fields and the shared HrefResolver
+    :param str typeof: type of rule to serialise, other rules are skipped
+    :param list expand: fields to expand into element types and names
+    :param int chunk_size: number of rules per chunk
+    :return: generator of dict
+    """
+    resolver = HrefResolver()
+    rules = iter(rules)
+    while True:
+        chunk = list(itertools.islice(rules, chunk_size))
+        if not chunk:
+            return
+        chunk = [rule for rule in chunk if rule.typeof == typeof]
+        for rule in chunk:
+            if expand and not rule.is_rule_section:
+                for field in expand:
+                    resolver.add(getattr(rule, field).all_as_href() or [])
+        resolver.resolve()
+        for rule in chunk:
+            yield to_yaml(rule, expand, resolver)
+            del rule.data
+
+
+class ElementStore(object):
+    """
+    Persistent element metadata cache shared across module invocations.
+    Each ansible task runs in a new process, so name to href resolution
+    done by one task is lost for the next one. When a task is run with
+    `smc_cache`, resolved elements are saved to a JSON file and reused by
+    later tasks until their `ttl` expires.
+
+    Entries hold the typeof, name, href and etag (when known) of an element
+    and are scoped by SMC URL and domain. The file is only rewritten while
+    holding an exclusive lock and is replaced atomically, so concurrent
+    writers (i.e. forks running against several hosts) merge their updates
+    and readers never see a partial file.
+
+    Entries served from the store are tracked during the run. Entries are
+    checked before use with a conditional request on their etag, and an
+    entry found stale (element deleted or renamed) is dropped and the
+    element is resolved again.
+
+    :param str path: path of the cache file
+    :param int ttl: time in seconds an entry is considered valid
+    :param str scope: scope of the entries, typically 'url|domain'
+    """
+
+    def __init__(self, path, ttl=3600, scope=''):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.scope = scope
+        self.served = {} # (typeof, name): Element
+        self._entries = None
+        self._updates = {} # key: entry, or None if removed
+
+    @staticmethod
+    def _key(typeof, name):
+        return '%s|%s' % (typeof, name)
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = read_json_file(self.path).get(self.scope, {})
+        return self._entries
+
+    def get(self, typeof, name):
+        """
+        Get a valid entry for the element
+
+        :param str typeof: typeof element
+        :param str name: name of element
+        :return: dict with keys typeof, href and etag, or None
+        :rtype: dict
+        """
+        key = self._key(typeof, name)
+        entry = self._updates[key] if key in self._updates else \
+            self.entries.get(key)
+        if entry and time.time() - entry.get('ts', 0) < self.ttl:
+            return entry
+
+    def get_element(self, typeof, name):
+        """
+        Return an element from a valid entry without querying the SMC.
+        The element is tracked so it can be validated when it is used.
+
+        :rtype: Element or None
+        """
+        entry = self.get(typeof, name)
+        if entry:
+            try:
+                element = Element.from_meta(
+                    name=name, type=entry['typeof'], href=entry['href'])
+            except (KeyError, SMCException):
+                return None
+            self.served[(typeof, name)] = element
+            return element
+
+    def get_valid_element(self, typeof, name):
+        """
+        Return an element from a valid entry, checked against the SMC with
+        a conditional request on the recorded etag. An unchanged element
+        is answered without a body. A changed element is kept when it
+        still has the name, and its etag is recorded. Entries of deleted
+        or renamed elements are dropped, for the caller to resolve the
+        element again. Entries stored without an etag are checked with a
+        full request, which records the etag for later runs.
+
+        :rtype: Element or None
+        """
+        entry = self.get(typeof, name)
+        if not entry:
+            return None
+        headers = {'Content-Type': 'application/json'}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        try:
+            element = Element.from_meta(
+                name=name, type=entry['typeof'], href=entry['href'])
+            result = prepared_request(
+                FetchElementFailed, href=entry['href'], headers=headers).read()
+        except (KeyError, SMCException):
+            result = None
+        if result is None or result.code not in (200, 304) or \
+                (result.code == 200 and (result.json or {}).get('name') != name):
+            self.discard(typeof, name)
+            return None
+        if result.code == 200:
+            element.data = ElementCache(result.json, etag=result.etag)
+            self.set(typeof, name, element, result.etag)
+        self.served[(typeof, name)] = element
+        return element
+
+    def set(self, typeof, name, element, etag=None):
+        """
+        Save the element resolved by typeof and name. The etag is taken
+        from the element when its data is loaded.
+
+        :param str typeof: typeof used to search the element
+        :param str name: name of element
+        :param Element element: the resolved element
+        :param str etag: etag of the element if it is known
+        """
+        if etag is None and 'data' in vars(element):
+            etag = element.data._etag
+        self._updates[self._key(typeof, name)] = dict(
+            typeof=element.typeof, href=element.href,
+            etag=etag, ts=time.time())
+
+    def discard(self, typeof, name):
+        """
+        Drop the entry for the element.
+        """
+        self._updates[self._key(typeof, name)] = None
+        self.served.pop((typeof, name), None)
+
+    def validate_served(self):
+        """
+        Validate entries served during this run against elements that
+        were loaded anyway. Entries are dropped if the element was renamed
+        and the etag is refreshed when it changed, without making any
+        additional query to the SMC.
+        """
+        for (typeof, name), element in list(self.served.items()):
+            if 'data' not in vars(element): # Never loaded, nothing to compare
+                continue
+            if element.data.get('name', name) != name:
+                self.discard(typeof, name)
+            else:
+                etag = element.data._etag
+                entry = self.get(typeof, name)
+                if entry and etag and entry.get('etag') != etag:
+                    self.set(typeof, name, element, etag)
+
+    def discard_served(self):
+        """
+        Drop all entries served during this run. Used when a run fails,
+        as one of them may be the reason why.
+        """
+        for typeof, name in list(self.served):
+            self.discard(typeof, name)
+
+    def flush(self):
+        """
+        Merge the updates of this run into the cache file. Expired
+        entries are pruned while the file is rewritten.
+        """
+        if not self._updates:
+            return
+
+        def merge(data):
+            entries = data.setdefault(self.scope, {})
+            for key, entry in self._updates.items():
+                if entry is None:
+                    entries.pop(key, None)
+                else:
+                    entries[key] = entry
+            now = time.time()
+            for scope_entries in data.values():
+                for key in [k for k, v in scope_entries.items()
+                            if now - v.get('ts', 0) >= self.ttl]:
+                    scope_entries.pop(key)
+
+        data = update_json_file(self.path, merge)
+        self._entries = data.get(self.scope, {})
+        self._updates = {}
+
+
+#: Element store of the current run, set by `ForcepointModuleBase.connect`
+#: when `smc_cache` is provided
+element_store = None
+
+
+class SessionCache(object):
+    """
+    Opt-in reuse of authenticated SMC sessions across module runs. Each
+    module run otherwise logs in and out of the SMC, so a play with
+    hundreds of tasks does as many full authentications.
+
+    The session cookie (and authorization token if any) obtained by a
+    login is saved in a private file, keyed by a digest of the SMC URL,
+    domain and API key, and is reused by the next runs with the same
+    credentials instead of logging in. Sessions are not logged out at the
+    end of a run. A session left idle for longer than `idle_timeout` is
+    not reused and a new login is made. If the SMC expired the session
+    in the meantime, smc-python re-authenticates on the first 401 using
+    the same credentials and the new cookie is saved.
+
+    :param str path: path of the session file, created with mode 0600
+    :param int idle_timeout: seconds after which an unused session is
+        no longer reused
+    """
+
+    def __init__(self, path, idle_timeout=600):
+        self.path = os.path.expanduser(path)
+        self.idle_timeout = idle_timeout
+
+    @staticmethod
+    def key(url, domain, api_key):
+        return hashlib.sha256('|'.join(
+            (url or '', domain or '', api_key or '')).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Get the saved session if it has not been idle for too long
+
+        :rtype: dict or None
+        """
+        entry = read_json_file(self.path).get(key)
+        if entry and time.time() - entry.get('last_used', 0) < self.idle_timeout:
+            return entry
+
+    def save(self, key, user_session):
+        """
+        Save the cookies of the smc-python session, marking it as used now
+        """
+        entry = dict(
+            cookies=requests.utils.dict_from_cookiejar(user_session.session.cookies),
+            token=user_session._token,
+            api_version=user_session.api_version,
+            last_used=time.time())
+        update_json_file(self.path, lambda data: data.update({key: entry}))
+
+    def drop(self, key):
+        update_json_file(self.path, lambda data: data.pop(key, None))
+
+
+_pool_adapter_class = None
+
+
+def pool_adapter_class():
+    """
+    Get the PoolAdapter transport adapter class. The class derives from
+    the requests HTTPAdapter and is defined on first use, so this module
+    still imports when requests or smc-python are missing.
+
+    :rtype: type
+    """
+    global _pool_adapter_class
+    if _pool_adapter_class is not None:
+        return _pool_adapter_class
+
+    class PoolAdapter(HTTPAdapter):
+        """
+        Transport adapter with configurable connection pool and TCP socket
+        options. This replaces the adapters mounted by smc-python at login when
+        `smc_connection_pool` is provided. The TLS settings are the same as
+        the smc-python SSLAdapter.
+
+        :param list socket_options: socket options set on every new connection
+        :param bool tls: mount for https connections
+        """
+
+        def __init__(self, socket_options=None, tls=False, **kwargs):
+            # Set before HTTPAdapter.__init__ which creates the pool manager
+            self.socket_options = socket_options
+            self.tls = tls
+            super(PoolAdapter, self).__init__(**kwargs)
+
+        def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+            if self.socket_options is not None:
+                pool_kwargs.update(socket_options=self.socket_options)
+            if self.tls:
+                pool_kwargs.update(timeout=720, ssl_version=ssl.PROTOCOL_TLSv1_2)
+            self._pool_connections = connections
+            self._pool_maxsize = maxsize
+            self._pool_block = block
+            self.poolmanager = PoolManager(
+                num_pools=connections,
+                maxsize=maxsize,
+                block=block,
+                **pool_kwargs)
+
+    _pool_adapter_class = PoolAdapter
+    return PoolAdapter
+
+
+def socket_options(pool_params):
+    """
+    Build the TCP socket options from the `smc_connection_pool` settings.
+    Keep alive probe settings are only applied on platforms supporting them.
+
+    :param dict pool_params: `smc_connection_pool` settings
+    :rtype: list
+    """
+    options = []
+    if pool_params.get('tcp_nodelay', True):
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+    if pool_params.get('keepalive', True):
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        for param, option in (('keepalive_idle', 'TCP_KEEPIDLE'),
+                              ('keepalive_interval', 'TCP_KEEPINTVL'),
+                              ('keepalive_count', 'TCP_KEEPCNT')):
+            if pool_params.get(param) and hasattr(socket, option):
+                options.append((socket.IPPROTO_TCP, getattr(socket, option),
+                                pool_params[param]))
+    return options
+
+
+def session_adapters(retry, pool_params=None):
+    """
+    Get the http and https transport adapters for the SMC session. Without
+    pool settings these are the adapters smc-python mounts at login.
+
+    :param Retry retry: retry policy of the adapters
+    :param dict pool_params: `smc_connection_pool` settings
+    :return: http adapter, https adapter
+    :rtype: tuple
+    """
+    if pool_params is None:
+        pool_maxsize = smc_session.Session.DEFAULT_POOL_MAXSIZE
+        return (HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize),
+                SSLAdapter(max_retries=retry, pool_maxsize=pool_maxsize))
+
+    kwargs = dict(
+        max_retries=retry,
+        pool_connections=pool_params.get('connections', 10),
+        pool_maxsize=pool_params.get('maxsize', 10),
+        pool_block=pool_params.get('block', False),
+        socket_options=socket_options(pool_params))
+    adapter_class = pool_adapter_class()
+    return adapter_class(**kwargs), adapter_class(tls=True, **kwargs)
+
+
+def login_url(params):
+    """
+    SMC URL the session logs in to: `smc_address`, otherwise the URL from
+    the smc-python configuration file or environment, loaded the same way
+    smc-python does on login.
+
+    :param dict params: dict of the SMC credential information
+    :raises ConfigLoadError: no URL is configured
+    :rtype: str
+    """
+    if params.get('smc_address'):
+        return params['smc_address']
+    try:
+        config = load_from_file(params.get('smc_alt_filepath'))
+    except ConfigLoadError:
+        config = load_from_environ()
+    return config['url']
+
+
+class RequestMetrics(object):
+    """
+    Counts and times the SMC REST calls made by a module run. The `hook`
+    method is installed as a requests response hook on the SMC session so
+    every call is recorded, grouped by method, entry point and status
+    code. Entry points are the resource path without the API version
+    and element ids, for example `elements/host`. Wall time of the
+    module phases is recorded with `start` and `stop`.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.timings = {}
+        self._started = {}
+
+    @staticmethod
+    def entry_point(url):
+        segments = [s for s in urlparse(url).path.split('/') if s]
+        if segments and segments[0].replace('.', '').isdigit():
+            segments = segments[1:]
+        return '/'.join(s for s in segments if not s.isdigit())
+
+    def hook(self, response, *args, **kwargs):
+        key = (response.request.method, self.entry_point(response.url),
+               response.status_code)
+        call = self.calls.setdefault(key, dict(count=0, time=0.0))
+        call['count'] += 1
+        call['time'] += response.elapsed.total_seconds()
+
+    def start(self, phase):
+        self._started[phase] = time.time()
+
+    def stop(self, phase):
+        started = self._started.pop(phase, None)
+        if started is not None:
+            self.timings[phase] = round(time.time() - started, 3)
+
+    def summary(self):
+        """
+        Summary returned in the module result as `smc_metrics`. Phases
+        still running, for example when the module fails, are stopped.
+
+        :rtype: dict
+        """
+        for phase in list(self._started):
+            self.stop(phase)
+        calls = [dict(method=method, entry_point=entry_point, status=status,
+                      count=call['count'], time=round(call['time'], 3))
+                 for (method, entry_point, status), call in sorted(
+                     self.calls.items(), key=lambda item: -item[1]['time'])]
+        return dict(
+            count=sum(call['count'] for call in calls),
+            time=round(sum(call['time'] for call in self.calls.values()), 3),
+            calls=calls,
+            timings=self.timings)
+
+
 class Cache(object):
     """
     Convenience cache object to reduce number of queries for a
@@ -54,11 +778,30 @@ class Cache(object):
     is not intended to have a `get_or_create` logic, therefore when
     validating the existence of elements, you should check missing
     before continuing the playbook run.
+
+    Elements are indexed by (typeof, name) so lookups and duplicate
+    checks are constant time regardless of the number of entries.
+
+    Names are resolved per typeof. When more than `batch_threshold`
+    names of the same type are requested, the type is listed in pages
+    (filtered by the common name prefix when there is one) and matched
+    locally instead of running one search per name. Listing stops when
+    the pages read outnumber the names left, see `iter_wanted`.
+
+    If an `ElementStore` is in use for this run, names are first looked
+    up in the store and elements resolved from the SMC are saved to it.
     """
 
-    def __init__(self):
+    def __init__(self, batch_threshold=10, page_size=500, store=None):
+        self.store = store if store is not None else element_store
         self.missing = []
         self.cache = {} # typeof: [Element1, Element2, ..]
+        self._index = {} # (typeof, name): Element
+        self._missing = set() # (typeof, name)
+        self._user_domains = {} # domain name: user domain element
+        self._browsed = {} # href: {name: [UserElement, ..]}
+        self.batch_threshold = batch_threshold
+        self.page_size = page_size
 
     def add_many(self, list_of_entries):
         """
@@ -70,10 +813,13 @@ class Cache(object):
         Where the key is a valid 'typeof' (SMC entry point)
         and value is a list of names to search
         """
+        by_type = {}
         for elements in list_of_entries:
             for typeof, values in elements.items():
-                for name in values:
-                    self._add_entry(typeof, name)
+                by_type.setdefault(typeof, []).extend(values)
+
+        for typeof, names in by_type.items():
+            self._add_entries(typeof, names)
 
     def add(self, dict_of_entries):
         """
@@ -81,12 +827,11 @@ class Cache(object):
 
             element = {'network': [network1,network2]}
         """
-        for typeof, values in dict_of_entries.items():
-            for name in values:
-                self._add_entry(typeof, name)
+        self.add_many([dict_of_entries])
 
     def _add_user_entries(self, typeof, users):
-        # User elements are fetched by direct href
+        # Users and groups are resolved by browsing their domain. Each
+        # domain and group along the DN is browsed once per run.
         domain_dict = {}
         for user in users:
             _user, _domain = user.split(',domain=')
@@ -97,30 +842,91 @@ class Cache(object):
             entry_point = 'external_ldap_user_domain' if domain != \
                 'InternalDomain' else 'internal_user_domain'
 
-            ldap = Search.objects.entry_point(entry_point)\
-                .filter(domain, exact_match=True).first()
+            if domain not in self._user_domains:
+                self._user_domains[domain] = Search.objects.entry_point(entry_point)\
+                    .filter(domain, exact_match=True).first()
 
+            ldap = self._user_domains[domain]
             if not ldap:
-                self.missing.append(
-                    dict(msg='Cannot find specified element',
-                         name=domain,
-                         type=entry_point))
+                if (entry_point, domain) not in self._missing:
+                    self._add_missing(entry_point, domain, 'Cannot find specified element')
                 continue
 
             for uid in uids:
+                name = '%s,domain=%s' % (uid, domain)
+                if ('user_element', name) in self._index or (typeof, name) in self._missing:
+                    continue
                 try:
-                    result = ldap.browse()
-                    self.cache.setdefault('user_element', []).extend(
-                        result)
+                    result = self._find_user(ldap, uid)
                 except UserElementNotFound as e:
-                    self.missing.append(
-                        dict(msg='Cannot find specified element: %s' % str(e),
-                             name=uid,
-                             type=typeof))
+                    self._add_missing(typeof, name, 'Cannot find specified element: %s' % str(e))
+                    continue
+                if result:
+                    self._store('user_element', name, result, persist=False)
+                else:
+                    self._add_missing(typeof, name, 'Cannot find specified element')
+
+    def _browse(self, container):
+        # Browse results of a domain or group by lower case name
+        if container.href not in self._browsed:
+            entries = {}
+            for entry in container.browse():
+                entries.setdefault(entry.name.lower(), []).append(entry)
+            self._browsed[container.href] = entries
+        return self._browsed[container.href]
+
+    @staticmethod
+    def _dn(value):
+        # DN in lower case without spaces around the RDN separators
+        return ','.join(rdn.strip() for rdn in re.split(r'(?<!\\),', value or '')).lower()
+
+    def _find_user(self, domain, uid):
+        """
+        Find the user or group with the given DN. The DN is walked from
+        the outermost RDN, skipping the RDNs of the domain base DN, and
+        only the groups on the path are browsed. Entries are matched by
+        name first and then by their unique_id, which is the full DN of
+        the entry with its domain: a group is only entered when it is an
+        ancestor of the DN, and an entry is only returned when its whole
+        DN matches. A DN within the base DN, like the base DN entry
+        itself, is matched against the top level entries of the domain.
+
+        :param Element domain: internal or LDAP user domain
+        :param str uid: DN of the user or group, without the domain
+        :rtype: UserElement or None
+        """
+        target = self._dn('%s,domain=%s' % (uid, domain.name))
+        rdns = [rdn.split('=', 1)[-1].strip().lower()
+                for rdn in re.split(r'(?<!\\),', uid)]
+
+        def walk(container, depth, in_base_dn):
+            for depth in range(depth, -1, -1):
+                for candidate in self._browse(container).get(rdns[depth], []):
+                    dn = self._dn(candidate.unique_id)
+                    if depth == 0:
+                        if dn == target:
+                            return candidate
+                    elif target.endswith(',%s' % dn) and hasattr(candidate, 'browse'):
+                        found = walk(candidate, depth - 1, False)
+                        if found:
+                            return found
+                if not in_base_dn:
+                    return None
+
+        found = walk(domain, len(rdns) - 1, True)
+        if found:
+            return found
+        for entries in self._browse(domain).values():
+            for entry in entries:
+                if self._dn(entry.unique_id) == target:
+                    return entry
+        return None
 
     def _add_entry(self, typeof, name):
-        # Add entry if it doesn't already exist
-        if self.get(typeof, name):
+        # Add entry if it doesn't already exist or was already reported missing
+        if (typeof, name) in self._index or (typeof, name) in self._missing:
+            return
+        if self.store and self._from_store(typeof, name):
             return
         try:
             if typeof == 'engine':
@@ -130,16 +936,71 @@ class Cache(object):
                 result = Search.objects.entry_point(typeof)\
                     .filter(name, exact_match=True).first()
             if result:
-                self.cache.setdefault(typeof, []).append(
-                    result)
+                self._store(typeof, name, result)
             else:
-                self.missing.append(
-                    dict(msg='Cannot find specified element',
-                         name=name,type=typeof))
+                self._add_missing(typeof, name, 'Cannot find specified element')
         except UnsupportedEntryPoint:
-            self.missing.append(
-                dict(msg='An invalid element type was specified',
-                     name=name,type=typeof))
+            self._add_missing(typeof, name, 'An invalid element type was specified')
+
+    def _add_entries(self, typeof, names):
+        # Resolve all names of a single type, batching when worthwhile
+        pending = []
+        for name in names:
+            key = (typeof, name)
+            if key in self._index or key in self._missing or name in pending:
+                continue
+            pending.append(name)
+
+        if self.store:
+            pending = [name for name in pending
+                       if not self._from_store(typeof, name)]
+
+        if len(pending) <= self.batch_threshold:
+            for name in pending:
+                self._add_entry(typeof, name)
+            return
+
+        try:
+            if typeof == 'engine':
+                iterator = Search.objects.context_filter('engine_clusters')
+            else:
+                iterator = Search.objects.entry_point(typeof)
+
+            prefix = os.path.commonprefix(pending)
+            if prefix:
+                iterator = iterator.filter(prefix)
+
+            for element in iter_wanted(
+                    iterator, set(pending), lambda element: element.name, self.page_size):
+                self._store(typeof, element.name, element)
+        except UnsupportedEntryPoint:
+            for name in pending:
+                self._add_missing(typeof, name, 'An invalid element type was specified')
+            return
+
+        # Anything not seen in the listing gets a last exact match search
+        # before being reported as missing
+        for name in pending:
+            self._add_entry(typeof, name)
+
+    def _from_store(self, typeof, name):
+        # Entries are checked before use, stale entries are resolved again
+        element = self.store.get_valid_element(typeof, name)
+        if element:
+            self._store(typeof, name, element, persist=False)
+            return True
+        return False
+
+    def _store(self, typeof, name, element, persist=True):
+        self._index[(typeof, name)] = element
+        self.cache.setdefault(typeof, []).append(element)
+        if persist and self.store:
+            self.store.set(typeof, name, element)
+
+    def _add_missing(self, typeof, name, msg):
+        self._missing.add((typeof, name))
+        self.missing.append(
+            dict(msg=msg, name=name, type=typeof))
 
     def get_href(self, typeof, name):
         result = self.get(typeof, name)
@@ -154,9 +1015,7 @@ class Cache(object):
         :param str name: name of element
         :rtype: element or None
         """
-        for value in self.cache.get(typeof, []):
-            if value.name == name:
-                return value
+        return self._index.get((typeof, name))
 
     def get_type(self, typeof):
         """
@@ -178,6 +1037,499 @@ class Cache(object):
         return out
 
 
+class HrefResolver(object):
+    """
+    Run wide memo of element metadata by href, used to expand element
+    references such as rule cells into their type and name. Hrefs are
+    queued with `add` and resolved together by `resolve`, each href
+    being resolved once per run however many times it is referenced.
+
+    The type of an element is the entry point in its href. When more
+    than `batch_threshold` hrefs of the same type are pending, the type
+    is listed in pages and matched locally instead of loading each
+    element, until the pages read outnumber the hrefs left. Other hrefs,
+    or hrefs not seen in the listing, are loaded one at a time.
+
+    :param int batch_threshold: pending hrefs of a type before the type
+        is listed
+    :param int page_size: number of elements requested per page
+    """
+
+    def __init__(self, batch_threshold=10, page_size=500):
+        self.batch_threshold = batch_threshold
+        self.page_size = page_size
+        self._elements = {} # href: (typeof, name)
+        self._pending = [] # hrefs in queue order
+
+    @staticmethod
+    def typeof(href):
+        """
+        Entry point of an element href, for example 'host' for
+        https://smc:8082/6.10/elements/host/123
+
+        :rtype: str or None
+        """
+        path = urlparse(href).path.rstrip('/').split('/')
+        if len(path) > 2 and path[-3] == 'elements':
+            return path[-2]
+
+    def add(self, hrefs):
+        """
+        Queue hrefs to resolve
+
+        :param list hrefs: element hrefs
+        """
+        for href in hrefs:
+            if href not in self._elements:
+                self._elements[href] = None
+                self._pending.append(href)
+
+    def resolve(self):
+        """
+        Resolve all queued hrefs
+        """
+        by_type = {}
+        for href in self._pending:
+            by_type.setdefault(self.typeof(href), []).append(href)
+        self._pending = []
+
+        for typeof, hrefs in by_type.items():
+            if typeof and len(hrefs) > self.batch_threshold:
+                wanted = set(hrefs)
+                try:
+                    for element in iter_wanted(Search.objects.entry_point(typeof),
+                            wanted, lambda element: element.href, self.page_size):
+                        self._elements[element.href] = (element.typeof, element.name)
+                except UnsupportedEntryPoint:
+                    pass
+                hrefs = [href for href in hrefs if href in wanted]
+
+            for href in hrefs:
+                element = Element.from_href(href)
+                self._elements[href] = (element.typeof, element.name)
+
+    def get(self, href):
+        """
+        Type and name of the element, resolving the href if it was not
+        queued
+
+        :param str href: element href
+        :return: (typeof, name)
+        :rtype: tuple
+        """
+        if self._elements.get(href) is None:
+            self.add([href])
+            self.resolve()
+        return self._elements[href]
+
+
+def longest_increasing_subsequence(values):
+    """
+    Find a longest strictly increasing subsequence of values. Used to
+    align rule lists, where the values are the current positions of the
+    rules in the wanted order: rules in the subsequence already are in
+    the wanted relative order.
+
+    :param list values: comparable values
+    :return: indexes in values of the subsequence, in order
+    :rtype: list
+    """
+    tails = [] # value at the end of the best subsequence of each length
+    tail_indexes = []
+    previous = [None] * len(values)
+    for index, value in enumerate(values):
+        length = bisect.bisect_left(tails, value)
+        if length:
+            previous[index] = tail_indexes[length - 1]
+        if length == len(tails):
+            tails.append(value)
+            tail_indexes.append(index)
+        else:
+            tails[length] = value
+            tail_indexes[length] = index
+    
+    result = []
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        result.append(index)
+        index = previous[index]
+    return result[::-1]
+
+
+class RuleIndex(object):
+    """
+    Index of the rules of a policy by rule tag, built from a single listing
+    of the rule collection the first time a rule is looked up. Listed rules
+    only contain their metadata, the tag id of a rule being the last segment
+    of its href, so no rule is fetched to build the index. The index keeps
+    the policy order and is updated in place when rules are created, moved
+    or deleted through it, keeping lookups valid for the whole run.
+
+    In check mode, operations only update the index so the outcome of a
+    run can be planned against the listed rules without writing to the
+    SMC. Planned rules get a placeholder reference in the collection.
+
+    :param rule_collection collection: rules of a policy, for example
+        `policy.fw_ipv4_access_rules`
+    :param bool check_mode: plan operations without applying them
+    """
+
+    def __init__(self, collection, check_mode=False):
+        self.collection = collection
+        self.check_mode = check_mode
+        self._planned = 0
+        self._rules = None
+        self._by_id = None
+        self._positions = None
+
+    @staticmethod
+    def tag_id(tag):
+        """
+        Rule id of a tag. Tags are in format '1234566.0' where the part
+        after the dot(.) is the revision of the rule.
+
+        :rtype: str or None
+        """
+        if tag:
+            return str(tag).lstrip('@').split('.')[0]
+
+    @staticmethod
+    def rule_id(rule):
+        return rule.href.rstrip('/').rsplit('/', 1)[-1]
+
+    @property
+    def rules(self):
+        """
+        Rules in policy order
+
+        :rtype: list
+        """
+        self._load()
+        return self._rules
+
+    def _load(self):
+        if self._rules is None:
+            self._rules = list(self.collection)
+            self._by_id = {self.rule_id(rule): rule for rule in self._rules}
+
+    def get(self, tag):
+        """
+        Get the rule by tag
+
+        :param str tag: rule tag, with or without revision
+        :rtype: Rule or None
+        """
+        self._load()
+        return self._by_id.get(self.tag_id(tag))
+
+    def position(self, tag):
+        """
+        Position of the rule in the policy, starting at 1
+
+        :param str tag: rule tag
+        :rtype: int or None
+        """
+        if self._positions is None:
+            self._positions = {self.rule_id(rule): pos
+                               for pos, rule in enumerate(self.rules, 1)}
+        return self._positions.get(self.tag_id(tag))
+
+    def _insert(self, rule, after=None, before=None):
+        # Rules added without a position are inserted at the top. A later
+        # listing includes applied rules, planned rules need the index
+        if self.check_mode:
+            self._load()
+        if self._rules is None:
+            return
+        if after and self.position(after):
+            index = self.position(after)
+        elif before and self.position(before):
+            index = self.position(before) - 1
+        else:
+            index = 0
+        self._rules.insert(index, rule)
+        self._by_id[self.rule_id(rule)] = rule
+        self._positions = None
+
+    def _remove(self, rule):
+        if self._rules is None:
+            return
+        indexed = self._by_id.pop(self.rule_id(rule), None)
+        if indexed is not None:
+            self._rules = [r for r in self._rules if r is not indexed]
+            self._positions = None
+
+    def create(self, **kwargs):
+        """
+        Create a rule in the collection. Takes the arguments of the rule
+        create method, `after` and `before` being rule tags.
+
+        :rtype: Rule
+        """
+        if self.check_mode:
+            self._planned += 1
+            rule = self.collection.cls(
+                name=kwargs.get('name'),
+                href='%s/planned-%d' % (self.collection.href, self._planned),
+                type=self.collection.cls.typeof)
+        else:
+            rule = self.collection.create(**kwargs)
+        self._insert(rule, kwargs.get('after'), kwargs.get('before'))
+        return rule
+
+    def create_blocks(self, new_rules):
+        """
+        Create new rules in bulk. Consecutive new rules form a block that
+        starts at a rule with `add_after` or `add_before`, or at the top of
+        the policy for the first rules, and following rules without a
+        position are placed after the previous rule of the block. Each rule
+        of a block is inserted against the same anchor, in reverse order
+        when inserting after it, so the relative ordering is kept without
+        fetching the tag of created rules. Rules are inserted without
+        validation, except the last one which validates the policy.
+
+        :param list new_rules: (rule, rule_dict) tuples of new rules, the
+            rule as defined in yaml and its create constructor args
+        :return: (created rule, rule_dict) tuples in creation order
+        :rtype: list
+        """
+        blocks = []
+        for rule, rule_dict in new_rules:
+            if not blocks or rule.get('add_after') or rule.get('add_before'):
+                blocks.append((rule.get('add_after'), rule.get('add_before'), []))
+            blocks[-1][2].append(rule_dict)
+
+        ordered = []
+        for after, before, block in blocks:
+            if after or not before:
+                ordered.extend(dict(rule_dict, after=after, before=None)
+                               for rule_dict in reversed(block))
+            else:
+                ordered.extend(dict(rule_dict, after=None, before=before)
+                               for rule_dict in block)
+
+        return [(self.create(validate=num == len(ordered), **rule_dict), rule_dict)
+                for num, rule_dict in enumerate(ordered, 1)]
+
+    def move(self, rule, after=None, before=None):
+        """
+        Move the rule after or before the rule with the given tag, or at
+        the top of the policy without a position. Like
+        `Rule.move_rule_after`, the rule is copied at the new position and
+        the original is deleted, but the copy is posted with the target
+        tag so the target rule is not fetched and the new rule reference
+        is known. Pending changes of the rule are part of the copy.
+
+        :param Rule rule: rule to move
+        :param str after: tag of the rule to move after
+        :param str before: tag of the rule to move before
+        :return: the moved rule
+        :rtype: Rule
+        """
+        if self.check_mode:
+            self._remove(rule)
+            self._insert(rule, after, before)
+            return rule
+        moved = ElementCreator(
+            rule.__class__,
+            json=rule.data,
+            exception=CreateRuleFailed,
+            href=self.collection.href,
+            params={'after': after} if after else {'before': before} if before else {})
+        rule.delete()
+        self._remove(rule)
+        self._insert(moved, after, before)
+        return moved
+
+    def delete(self, rule):
+        """
+        Delete the rule from the policy
+
+        :param Rule rule: rule to delete
+        """
+        if not self.check_mode:
+            rule.delete()
+        self._remove(rule)
+
+
+class RuleOperations(object):
+    """
+    Rule operations shared by the rule modules. Rules are created, moved
+    and deleted through the `rule_index` of the module and each operation
+    is added to the results. When running in check or diff mode, the
+    module sets `diff` to a list and the rule before and after each
+    operation is added to it.
+
+    Modules define `normalise`, returning the normalised rule compared in
+    the diff from the rule json (or None) and the rule create constructor
+    args.
+    """
+    rule_index = None
+    diff = None
+
+    def create_rules(self, new_rules):
+        """
+        Create new rules in bulk, in blocks anchored on `add_after` or
+        `add_before`. See `RuleIndex.create_blocks`.
+
+        :param list new_rules: (rule, rule_dict) tuples of new rules
+        :return: whether rules were created
+        :rtype: bool
+        """
+        created = self.rule_index.create_blocks(new_rules)
+        for rule, rule_dict in created:
+            self.record(rule, 'created', after=self.normalise(None, rule_dict))
+        return bool(created)
+
+    def move(self, rule, diff, after=None, before=None):
+        """
+        Move the rule through the rule index, adding the position of the
+        rule before and after the move to the diff.
+
+        :param Rule rule: rule to move
+        :param dict diff: diff of the rule, updated in place
+        :param str after: tag of the rule to move after
+        :param str before: tag of the rule to move before
+        :return: the moved rule
+        :rtype: Rule
+        """
+        position = self.position(rule)
+        rule = self.rule_index.move(rule, after=after, before=before)
+        diff.setdefault('before', {}).update(position=position)
+        diff.setdefault('after', {}).update(position=self.position(rule))
+        return rule
+
+    def position(self, rule):
+        """
+        Position of the rule in the policy, as known by the rule index
+
+        :rtype: int or None
+        """
+        return self.rule_index.position(RuleIndex.rule_id(rule))
+
+    def record(self, rule, action, changes=None, before=None, after=None):
+        """
+        Add an operation on a rule to the results. When running in check
+        or diff mode, the rule before and after the operation is added to
+        the diff. In check mode the operations are only planned.
+
+        :param Rule rule: rule created, modified or deleted
+        :param str action: created, modified or deleted
+        :param list changes: changed fields of a modified rule
+        :param dict before: rule before the operation
+        :param dict after: rule after the operation
+        """
+        state = {
+            'rule': rule.name,
+            'type': rule.typeof,
+            'action': action}
+        if changes is not None:
+            state.update(changes=changes)
+        self.results['state'].append(state)
+
+        if self.diff is not None:
+            self.diff.append(dict(
+                before_header='%s (%s)' % (rule.name, action),
+                after_header='%s (%s)' % (rule.name, action),
+                before=before or {},
+                after=after or {}))
+
+
+class RuleSnapshot(object):
+    """
+    Local snapshot of the rules of a policy, saved in a JSON file and
+    keyed by rule id. Each entry holds the rule tag, which carries the
+    rule revision, the etag of the rule and the rule as serialised by
+    the caller.
+
+    When refreshed, the rules are listed once and each rule known by
+    the snapshot is fetched with a conditional request on its etag. An
+    unchanged rule is answered without a body and its entry is reused,
+    so only new and changed rules are fetched and serialised again.
+    Rules no longer listed are dropped from the snapshot.
+
+    :param str path: path of the snapshot file
+    :param rule_collection collection: rules of a policy, for example
+        `policy.fw_ipv4_access_rules`
+    :param str variant: distinguishes snapshots of the same policy
+        serialised differently
+    """
+
+    def __init__(self, path, collection, variant=''):
+        self.path = os.path.expanduser(path)
+        self.scope = '%s|%s|%s' % (collection.href, session.domain, variant)
+        self.added = []
+        self.changed = []
+        self.deleted = []
+        self.unchanged = 0
+
+    def refresh(self, rules, serialise):
+        """
+        Refresh the snapshot from the listed rules and save it.
+
+        :param list rules: rules listed from the policy, in policy order
+        :param callable serialise: called with the new and changed rules,
+            returns an iterable of the serialised rules, each with the
+            rule `tag`, in the same order
+        :return: serialised rules in policy order
+        :rtype: list
+        """
+        previous = read_json_file(self.path).get(self.scope, {})
+        entries = {}
+        fetch = {}
+        for rule in rules:
+            rule_id = RuleIndex.rule_id(rule)
+            entry = previous.get(rule_id)
+            if entry and entry.get('etag'):
+                result = prepared_request(
+                    FetchElementFailed,
+                    href=rule.href,
+                    headers={'Content-Type': 'application/json',
+                             'If-None-Match': entry['etag']}).read()
+                if result.code == 304:
+                    entries[rule_id] = entry
+                    self.unchanged += 1
+                    continue
+                rule.data = ElementCache(result.json, etag=result.etag)
+            fetch[rule_id] = rule
+
+        for record in serialise(list(fetch.values())):
+            rule_id = RuleIndex.tag_id(record.get('tag'))
+            # The rule data is still loaded while its record is handled
+            entries[rule_id] = dict(
+                tag=record.get('tag'),
+                etag=fetch[rule_id].data._etag,
+                rule=record)
+            if rule_id in previous:
+                self.changed.append(record.get('tag'))
+            else:
+                self.added.append(record.get('tag'))
+
+        self.deleted = [entry.get('tag') for rule_id, entry in previous.items()
+                        if rule_id not in entries]
+
+        update_json_file(self.path, lambda data: data.update({self.scope: entries}))
+        return [entries[RuleIndex.rule_id(rule)]['rule'] for rule in rules
+                if RuleIndex.rule_id(rule) in entries]
+
+    def summary(self):
+        """
+        Tags added, changed and deleted by the last refresh
+
+        :rtype: dict
+        """
+        return dict(
+            path=self.path,
+            added=self.added,
+            changed=self.changed,
+            deleted=self.deleted,
+            unchanged=self.unchanged)
+
+
+# Argspecs resolved in this process, keyed by module.class.method
+_argspecs = {}
+
+
 def get_method_argspec(clazz, method=None):
     """
     Get method argspec. Return a 2-tuple:
@@ -185,14 +1537,26 @@ def get_method_argspec(clazz, method=None):
     Each tuple holds a list of the relevant args either
     required or valid.
 
+    Argspecs are taken from the precomputed table for the installed
+    smc-python version when available, otherwise introspected once
+    per process.
+
     :rtype: tuple
     """
-    argspec = inspect.getfullargspec(getattr(clazz, method if method else 'create'))
-    valid_args = argspec.args[1:]
-    args = []
-    if argspec.defaults:
-        args = argspec.args[:-len(argspec.defaults)][1:]
-    return (args, valid_args)
+    method = method if method else 'create'
+    cls = clazz if inspect.isclass(clazz) else type(clazz)
+    key = '%s.%s.%s' % (cls.__module__, cls.__name__, method)
+    if key not in _argspecs:
+        argspec = ARGSPECS.get(smc_version, {}).get(key)
+        if argspec is None:
+            spec = inspect.getfullargspec(getattr(clazz, method))
+            args = []
+            if spec.defaults:
+                args = spec.args[:-len(spec.defaults)][1:]
+            argspec = (args, spec.args[1:])
+        _argspecs[key] = argspec
+    args, valid_args = _argspecs[key]
+    return (list(args), list(valid_args))
 
 
 def required_args(clazz, method=None):
@@ -233,6 +1597,26 @@ def allowed_args_by_lookup(typeof, method=None):
     return allowed_args(clazz, method)
 
 
+# Type dicts built in this process, keyed by function and map_only
+_type_dicts = {}
+
+
+def memoize_type_dict(func):
+    """
+    Build the type dict once per process. Callers get a copy as modules
+    update the returned dict.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        if key not in _type_dicts:
+            _type_dicts[key] = func(*args, **kwargs)
+        return {t: dict(v, attr=list(v['attr'])) if 'attr' in v else dict(v)
+                for t, v in _type_dicts[key].items()}
+    return wrapper
+
+
+@memoize_type_dict
 def element_type_dict(map_only=False):
     """
     Type dict constructed with valid `create` constructor arguments.
@@ -259,6 +1643,7 @@ def element_type_dict(map_only=False):
     return types
 
 
+@memoize_type_dict
 def ro_element_type_dict(map_only=False):
     """
     Type dict of read-only network elements. These elements can be
@@ -280,6 +1665,7 @@ def ro_element_type_dict(map_only=False):
     return types
 
 
+@memoize_type_dict
 def service_type_dict(map_only=False):
     """
     Type dict for serviec elements and groups.
@@ -307,6 +1693,7 @@ def service_type_dict(map_only=False):
     return types
 
 
+@memoize_type_dict
 def ro_service_type_dict():
     """
     Type dict of read-only service elements. These elements can be
@@ -456,6 +1843,52 @@ def element_dict_from_obj(element, type_dict, expand=None):
         return dict(name=element.name, type=element.typeof)
 
 
+class RunContext(object):
+    """
+    Capabilities and licensing of the connected SMC. These are fetched
+    once per module run and shared by all callers, instead of querying
+    the SMC for every node or rule. The context is reset on connect.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._unlicensed = None
+        self._versions = {}
+
+    @property
+    def unlicensed(self):
+        """
+        Names of the unlicensed components
+
+        :rtype: set
+        """
+        if self._unlicensed is None:
+            self._unlicensed = set(
+                comp.get('name') for comp in System().unlicensed_components())
+        return self._unlicensed
+
+    def api_version_at_least(self, version):
+        """
+        Check the API version of the session is at least the version given
+
+        :param str version: minimum API version, i.e. '6.6'
+        :rtype: bool
+        """
+        key = (session.api_version, version)
+        if key not in self._versions:
+            try:
+                self._versions[key] = StrictVersion(session.api_version) >= \
+                    StrictVersion(version)
+            except (TypeError, ValueError):
+                self._versions[key] = False
+        return self._versions[key]
+
+
+run_context = RunContext()
+
+
 def is_sixdotsix_compat():
     """
     Switch to validate version of SMC. There were changes in 6.6 that
@@ -465,22 +1898,16 @@ def is_sixdotsix_compat():
 
     :rtype: bool
     """
-    try:
-        result = StrictVersion(session.api_version) >=  StrictVersion("6.6")
-    except ValueError:
-        pass
-    return result
+    return run_context.api_version_at_least('6.6')
+
 
 def is_licensed(name):
     """
     return true if element given by name is unlicensed
     :rtype: bool
     """
-    smc_system = System()
-    unlicensed=[]
-    for comp in smc_system.unlicensed_components():
-        unlicensed.append(comp.get("name"))
-    return not name in unlicensed
+    return name not in run_context.unlicensed
+
 
 def smc_argument_spec():
     return dict(
@@ -491,7 +1918,11 @@ def smc_argument_spec():
         smc_domain=dict(type='str'),
         smc_alt_filepath=dict(type='str'),
         smc_extra_args=dict(type='dict'),
-        smc_logging=dict(type='dict')
+        smc_logging=dict(type='dict'),
+        smc_cache=dict(type='dict'),
+        smc_session=dict(type='dict'),
+        smc_connection_pool=dict(type='dict'),
+        smc_metrics=dict(type='bool', default=False)
     )
 
 
@@ -501,7 +1932,8 @@ def fact_argument_spec():
         limit=dict(default=0, type='int'),
         exact_match=dict(default=False, type='bool'),
         case_sensitive=dict(default=True, type='bool'),
-        as_yaml=dict(default=False, type='bool')
+        as_yaml=dict(default=False, type='bool'),
+        page_size=dict(default=0, type='int')
     )
 
 
@@ -511,6 +1943,11 @@ class ForcepointModuleBase(object):
                  required_one_of=None, add_file_common_args=False,
                  supports_check_mode=False, is_fact=False):
 
+        self.element_store = None
+        self.session_cache = None
+        self.session_key = None
+        self.metrics = None
+
         argument_spec = smc_argument_spec()
         if is_fact:
             argument_spec.update(fact_argument_spec())
@@ -535,10 +1972,18 @@ class ForcepointModuleBase(object):
                 self.module.fail_json(msg='Could not import smc-python required by this module')
 
             self.check_mode = self.module.check_mode
+            if self.module.params.get('smc_metrics'):
+                self.metrics = RequestMetrics()
+                self.metrics.start('connect')
             self.connect(self.module.params)
             logger.debug("module.params={}".format(self.module.params))
 
+            if self.metrics:
+                self.metrics.stop('connect')
+                self.metrics.start('exec_module')
             result = self.exec_module(**self.module.params)
+            if self.metrics:
+                self.metrics.stop('exec_module')
             self.success(**result)
 
     def connect(self, params):
@@ -549,6 +1994,7 @@ class ForcepointModuleBase(object):
         
         :param dict params: dict of the SMC credential information
         """
+        run_context.reset()
         try:
             if params.get('smc_logging') is not None:
                 if 'path' not in params['smc_logging']:
@@ -558,30 +2004,190 @@ class ForcepointModuleBase(object):
                     log_level=params['smc_logging'].get('level', 10),
                     path=params['smc_logging']['path'])
 
-            if 'smc_address' and 'smc_api_key' in params:    
-                extra_args = params.get('smc_extra_args')
-                # When connection parameters are defined, alt_filepath is ignored.
-                session.login(
-                    url=params.get('smc_address'),
-                    api_key=params.get('smc_api_key'),
-                    api_version=params.get('smc_api_version'),
-                    timeout=params.get('smc_timeout'),
-                    domain=params.get('smc_domain'),
-                    **(extra_args or {}))
-            elif 'smc_alt_filepath' in params:
-                # User specified to look in file
-                session.login(alt_filepath=params['smc_alt_filepath'])
+            if params.get('smc_session') is not None:
+                self.set_session_cache(params)
+
+            resumed = self.session_cache and self.resume_session(params)
+            if resumed:
+                logger.debug('Reusing saved SMC session for: %s', params.get('smc_address'))
             else:
-                # From user ~.smcrc or environment
-                session.login()
+                if self.metrics:
+                    # Log in on a session with the metrics hook so the login
+                    # calls are counted. Pool settings are mounted with it
+                    self.attach_http_session(
+                        login_url(params), pool_params=params.get('smc_connection_pool'))
+
+                if 'smc_address' and 'smc_api_key' in params:    
+                    extra_args = params.get('smc_extra_args')
+                    # When connection parameters are defined, alt_filepath is ignored.
+                    session.login(
+                        url=params.get('smc_address'),
+                        api_key=params.get('smc_api_key'),
+                        api_version=params.get('smc_api_version'),
+                        timeout=params.get('smc_timeout'),
+                        domain=params.get('smc_domain'),
+                        **(extra_args or {}))
+                elif 'smc_alt_filepath' in params:
+                    # User specified to look in file
+                    session.login(alt_filepath=params['smc_alt_filepath'])
+                else:
+                    # From user ~.smcrc or environment
+                    session.login()
+
+                if params.get('smc_connection_pool') is not None and not self.metrics:
+                    self.mount_connection_pool(params['smc_connection_pool'])
+
+            if params.get('smc_cache') is not None:
+                self.set_element_store(params['smc_cache'])
         
         except (ConfigLoadError, SMCException) as err:
             self.fail(msg=str(err), exception=traceback.format_exc())
 
+    def set_session_cache(self, params):
+        """
+        Enable reuse of saved SMC sessions for this run. Sessions are keyed
+        by URL, domain and API key, therefore these must be provided as
+        module parameters.
+
+        :param dict params: dict of the SMC credential information
+        """
+        session_params = params['smc_session']
+        if 'path' not in session_params:
+            self.fail(msg='You must specify a path parameter for the SMC session.')
+        if not params.get('smc_address') or not params.get('smc_api_key'):
+            self.fail(msg='Reusing SMC sessions requires smc_address and smc_api_key.')
+
+        self.session_cache = SessionCache(
+            path=session_params['path'],
+            idle_timeout=session_params.get('idle_timeout', 600))
+        self.session_key = SessionCache.key(
+            params['smc_address'], params.get('smc_domain'), params['smc_api_key'])
+
+    def resume_session(self, params):
+        """
+        Attach a saved session cookie to the smc-python session instead of
+        logging in. The requests session is mounted the same way smc-python
+        does on login, and the login parameters are kept so smc-python can
+        transparently re-authenticate if the SMC expired the session.
+
+        :param dict params: dict of the SMC credential information
+        :return: True if a saved session was attached
+        :rtype: bool
+        """
+        entry = self.session_cache.get(self.session_key)
+        if not entry:
+            return False
+
+        extra_args = dict(params.get('smc_extra_args') or {})
+        verify = extra_args.pop('verify', True)
+        url = params['smc_address']
+        login_params = dict(
+            url=url,
+            api_key=params['smc_api_key'],
+            api_version=entry['api_version'],
+            timeout=params.get('smc_timeout'),
+            domain=params.get('smc_domain'),
+            verify=verify,
+            kwargs=extra_args)
+
+        http = self.attach_http_session(
+            url, verify, params.get('smc_connection_pool'))
+        http.cookies.update(entry.get('cookies', {}))
+
+        session._params = {k: v for k, v in login_params.items() if v is not None}
+        session._token = entry.get('token')
+        try:
+            load_entry_points(session)
+        except SMCException:
+            session._session = None
+            return False
+        session.manager._register(session)
+        return True
+
+    def attach_http_session(self, url, verify=True, pool_params=None):
+        """
+        Attach a new requests session to the smc-python session, mounted
+        the same way smc-python does on login. smc-python authenticates
+        with an attached session instead of creating one, so the metrics
+        hook installed here also records the login calls.
+
+        :param str url: SMC URL
+        :param verify: verify setting of the requests session
+        :param dict pool_params: `smc_connection_pool` settings
+        :rtype: requests.Session
+        """
+        retry = Retry(
+            total=smc_session.MAX_RETRY,
+            read=smc_session.MAX_RETRY,
+            connect=smc_session.MAX_RETRY,
+            backoff_factor=0.3,
+            status_forcelist=smc_session.ERROR_CODES_SUPPORTING_AUTO_RETRY)
+        adapter, ssladapter = session_adapters(retry, pool_params)
+        http = requests.Session()
+        http.verify = verify
+        http.mount('http://', adapter)
+        http.mount('https://', ssladapter)
+        if self.metrics:
+            http.hooks['response'].append(self.metrics.hook)
+
+        session._session = http
+        session._connpool = ssladapter.get_connection(url)
+        return http
+
+    def mount_connection_pool(self, pool_params):
+        """
+        Replace the adapters mounted by smc-python at login with adapters
+        using the pool and TCP settings from `smc_connection_pool`. The
+        retry policy of the login adapters is kept.
+
+        :param dict pool_params: `smc_connection_pool` settings
+        """
+        http = session.session
+        retry = http.get_adapter('https://').max_retries
+        adapter, ssladapter = session_adapters(retry, pool_params)
+        for prefix, new_adapter in (('http://', adapter), ('https://', ssladapter)):
+            http.adapters[prefix].close()
+            http.mount(prefix, new_adapter)
+        session._connpool = ssladapter.get_connection(session.url)
+
+    def set_element_store(self, cache_params):
+        """
+        Enable the persistent element cache for this run. Entries are
+        scoped to the SMC URL and domain of the current session.
+
+        :param dict cache_params: `smc_cache` settings, path and ttl
+        """
+        global element_store
+        if 'path' not in cache_params:
+            self.fail(msg='You must specify a path parameter for the SMC cache.')
+
+        element_store = ElementStore(
+            path=cache_params['path'],
+            ttl=cache_params.get('ttl', 3600),
+            scope='%s|%s' % (session.url, session.domain))
+        self.element_store = element_store
+
     def disconnect(self):
         """
         Disconnect session from SMC after ansible run
         """
+        if self.element_store:
+            try:
+                self.element_store.validate_served()
+                self.element_store.flush()
+            except (IOError, OSError) as err:
+                logger.warning('Unable to save the SMC cache: %s', err)
+
+        if self.session_cache:
+            # Keep the session open for the next module run
+            try:
+                if session.session is not None:
+                    self.session_cache.save(self.session_key, session)
+                else:
+                    self.session_cache.drop(self.session_key)
+                return
+            except (IOError, OSError) as err:
+                logger.warning('Unable to save the SMC session: %s', err)
         try:
             session.logout()
         except SMCException:
@@ -600,21 +2206,7 @@ class ForcepointModuleBase(object):
         :return: list of metadata results
         :rtype: list
         """
-        if self.filter:
-            # Find specific
-            iterator = Search.objects\
-                .context_filter(self.element)\
-                .filter(self.filter,
-                        exact_match=self.exact_match,
-                        case_sensitive=self.case_sensitive)            
-        else:
-            # Find all
-            iterator = Search.objects.context_filter(self.element)
-        
-        if self.limit >= 1:
-            iterator = iterator.limit(self.limit)
-               
-        return list(iterator)
+        return list(self.iter_by_context())
     
     def search_by_type(self, typeof):
         """
@@ -627,6 +2219,37 @@ class ForcepointModuleBase(object):
         :return: list of metadata results
         :rtype: list
         """
+        return list(self.iter_by_type(typeof))
+
+    def iter_by_context(self):
+        """
+        Streaming version of `search_by_context`. Results are fetched
+        `page_size` records at a time and fetching stops once `limit`
+        results were consumed.
+
+        :return: generator of metadata results
+        """
+        if self.filter:
+            # Find specific
+            iterator = Search.objects\
+                .context_filter(self.element)\
+                .filter(self.filter,
+                        exact_match=self.exact_match,
+                        case_sensitive=self.case_sensitive)
+        else:
+            # Find all
+            iterator = Search.objects.context_filter(self.element)
+        return self.iter_results(iterator)
+
+    def iter_by_type(self, typeof):
+        """
+        Streaming version of `search_by_type`. Results are fetched
+        `page_size` records at a time and fetching stops once `limit`
+        results were consumed.
+
+        :param str typeof: SMC API entry point
+        :return: generator of metadata results
+        """
         if self.filter:
             iterator = typeof.objects\
                 .filter(self.filter,
@@ -634,11 +2257,21 @@ class ForcepointModuleBase(object):
                         case_sensitive=self.case_sensitive)
         else:
             iterator = typeof.objects.all()
-        
+        return self.iter_results(iterator)
+
+    def iter_results(self, iterator):
+        # ElementCollection.limit is only applied while iterating, so
+        # without paging the limit is requested from the SMC as a range of
+        # results. Results are still sliced if the range is not honoured
+        page_size = getattr(self, 'page_size', 0)
+        if not page_size:
+            if self.limit >= 1:
+                return itertools.islice(iter(iterator.between(0, self.limit)), self.limit)
+            return iter(iterator)
         if self.limit >= 1:
-            iterator = iterator.limit(self.limit)
-        
-        return list(iterator)
+            return itertools.islice(
+                iter_pages(iterator, min(page_size, self.limit)), self.limit)
+        return iter_pages(iterator, page_size)
     
     def fetch_element(self, cls):
         """
@@ -648,7 +2281,24 @@ class ForcepointModuleBase(object):
         :param Element cls: class of type Element
         :return: element or None
         """
-        return cls.objects.filter(self.name, exact_match=True).first()
+        store = self.element_store
+        if store:
+            element = store.get_element(cls.typeof, self.name)
+            if element:
+                # Callers load the element anyway, loading it here
+                # validates the entry without an additional query
+                try:
+                    if element.data.get('name') == self.name:
+                        store.set(cls.typeof, self.name, element, element.data._etag)
+                        return element
+                except SMCException:
+                    pass
+                store.discard(cls.typeof, self.name)
+
+        element = cls.objects.filter(self.name, exact_match=True).first()
+        if element and store:
+            store.set(cls.typeof, self.name, element)
+        return element
     
     def add_tags(self, element, tags):
         """    
@@ -700,15 +2350,31 @@ class ForcepointModuleBase(object):
         """
         Fail the request with message
         """
-        self.disconnect()
+        if self.element_store:
+            self.element_store.discard_served()
+        self.timed_disconnect()
+        if self.metrics:
+            kwargs.update(smc_metrics=self.metrics.summary())
         self.module.fail_json(msg=msg, **kwargs)
         
     def success(self, **result):
         """
         Success with result messages
         """
-        self.disconnect()
+        self.timed_disconnect()
+        if self.metrics:
+            result.update(smc_metrics=self.metrics.summary())
         self.module.exit_json(**result)
+
+    def timed_disconnect(self):
+        """
+        Disconnect, recording the wall time when metrics are enabled
+        """
+        if self.metrics:
+            self.metrics.start('disconnect')
+        self.disconnect()
+        if self.metrics:
+            self.metrics.stop('disconnect')
         
     def is_element_valid(self, element, type_dict, check_required=True):
         """
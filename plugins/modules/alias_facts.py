@@ -164,7 +164,7 @@ class AliasFacts(ForcepointModuleBase):
 
         else:
                     
-            result = self.search_by_type(Alias)
+            result = self.iter_by_type(Alias)
             
             if self.filter:
                 aliases = [alias_dict_from_obj(alias, self.engine) for alias in result]
@@ -125,7 +125,7 @@ class CategoryFacts(ForcepointModuleBase):
         for name, value in kwargs.items():
             setattr(self, name, value)
         
-        result = self.search_by_type(Category)
+        result = self.iter_by_type(Category)
         # Search by specific element type
         if self.filter:    
             elements = [category_dict_from_obj(element) for element in result]
@@ -709,7 +709,7 @@ class EngineFacts(ForcepointModuleBase):
         for name, value in kwargs.items():
             setattr(self, name, value)
         
-        result = self.search_by_context()
+        result = self.iter_by_context()
         engines = []
         if self.filter:
             if self.as_yaml:
@@ -209,7 +209,7 @@ class ExternalGWFacts(ForcepointModuleBase):
                 self.fail(msg='Invalid expandable attribute: %s provided. Valid '
                     'options are: %s'  % (attr, expands))
            
-        result = self.search_by_type(ExternalGateway)
+        result = self.iter_by_type(ExternalGateway)
         # Search by specific element type
         if self.filter:
             if self.as_yaml:
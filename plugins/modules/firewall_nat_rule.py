@@ -17,6 +17,12 @@ description:
     or a sub-policy. Source, destination and service elements can be used and
     referenced by their type and name (they must be pre-created).
     This module requires SMC >= 6.4.3 or above to support changes to NAT rules
+  - Existing rules are only updated for the NAT ports set in the translated
+    value. Ports not set are left unchanged on the rule, and do not make the
+    rule count as changed.
+  - In check mode, rules are listed once and the operations are planned
+    against the listed rules without any write to the SMC. The planned
+    operations are returned in the state and the diff of the results.
 
 version_added: '2.5'
 
@@ -155,6 +161,17 @@ options:
     choices:
       - present
       - absent
+  bulk:
+    description:
+      - Create new rules in bulk. New rules are created before changes to existing
+        rules are applied and are placed in the order they are defined. A rule without
+        I(add_after) or I(add_before) follows the previous new rule, and the first new
+        rules are placed at the top of the policy. Rules are inserted without
+        validation, the policy being validated once with the last rule. Use this when
+        importing many NAT rules.
+    required: false
+    default: false
+    type: bool
     
 '''
 
@@ -249,6 +266,31 @@ EXAMPLES = '''
         host:
         - host-3.3.3.3
       used_on: ANY
+
+- name: Import NAT rules in bulk, in this order after the specified rule
+  firewall_nat_rule:
+    policy: TestPolicy
+    bulk: true
+    rules:
+    - name: static_src_nat for host-4.4.4.4
+      add_after: '2097193.0'
+      sources:
+        host:
+        - host-4.4.4.4
+      static_src_nat:
+        automatic_proxy: true
+        translated_value:
+          ip_descriptor: 1.1.1.1
+    - name: dynamic_src_nat for host-3.3.3.3
+      sources:
+        host:
+        - host-3.3.3.3
+      dynamic_src_nat:
+        automatic_proxy: true
+        translated_value:
+          ip_descriptor: 1.1.1.2
+          max_port: 65535
+          min_port: 1024
 '''
 
 
@@ -261,12 +303,18 @@ state:
   description: The current state of the element
   return: always
   type: dict
+diff:
+  description: Rules before and after each operation, with the position of
+    moved and deleted rules. Only the fields set in the rule definition are
+    compared
+  returned: check mode or diff mode
+  type: list
 '''
 
 import traceback
 from ansible.module_utils.six import string_types
 from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_util import (
-    ForcepointModuleBase, Cache)
+    ForcepointModuleBase, Cache, RuleIndex, RuleOperations, fingerprint, normalise_cell)
 
 
 try:
@@ -344,6 +392,92 @@ def compare_rules(rule, rule_dict):
     return changes
 
 
+def _nat_value(options, nat):
+    # Translated value of the NAT type in the rule options, or None
+    nat_options = options.get(nat)
+    if not nat_options:
+        return None
+    if nat == 'dynamic_src_nat':
+        return (nat_options.get('translation_values') or [{}])[0]
+    return nat_options.get('translated_value') or {}
+
+
+def normalise_nat_rule(data, rule_dict):
+    """
+    Normalised form of a NAT rule for the fields compared by
+    `compare_rules`. Only the NAT settings specified in the rule dict
+    are considered, so the rule as defined in yaml and the rule fetched
+    from the SMC have the same form when `compare_rules` would find no
+    change. Like `compare_rules`, which only updates the NAT ports that
+    are set, ports not set in the rule dict are not compared.
+    
+    :param dict data: rule json, or None to normalise the rule dict
+    :param dict rule_dict: rule dict from yaml, matching the create
+        constructor args
+    :rtype: dict
+    """
+    desired = data is None
+    if desired:
+        data = {}
+    options = data.get('options', {})
+    
+    rule = dict(
+        is_disabled=rule_dict.get('is_disabled') if desired else data.get('is_disabled'),
+        name=rule_dict.get('name') if desired else data.get('name'))
+    
+    if 'comment' in rule_dict:
+        rule.update(comment=rule_dict['comment'] if desired else data.get('comment'))
+    
+    for field in ('sources', 'destinations', 'services'):
+        rule[field] = normalise_cell(rule_dict.get(field) if desired else data.get(field))
+    
+    for nat in nat_type:
+        if nat not in rule_dict:
+            rule[nat] = False if desired else nat in options
+            continue
+        value = rule_dict[nat]
+        key = 'element' if hasattr(value, 'href') else 'ip_descriptor'
+        ports = dict(zip(('min_port', 'max_port'),
+                         rule_dict.get('%s_ports' % nat, (None, None))))
+        if desired:
+            translated = {key: value.href if key == 'element' else value}
+            translated.update((port, number) for port, number in ports.items()
+                              if number is not None)
+        else:
+            current = _nat_value(options, nat)
+            translated = None if current is None else dict(
+                [(key, current.get(key))] + [(port, current.get(port))
+                    for port, number in ports.items() if number is not None])
+        rule[nat] = translated
+    
+    return rule
+
+
+def rule_changes(rule, rule_dict, diff=None):
+    """
+    Compare a fingerprint of the NAT rule fetched from the policy to the
+    fingerprint of the rule dict first. Only when the fingerprints
+    differ is the rule walked with `compare_rules`, which merges the
+    changes in the rule. Rule sections are always compared.
+    
+    :param IPv4NATRule rule: rule fetched from policy
+    :param dict rule_dict: rule dict from yaml, matching the create
+        constructor args
+    :param dict diff: updated with the normalised rule before and after
+        the changes when provided
+    :return: list of changes
+    :rtype: list
+    """
+    before = normalise_nat_rule(rule.data, rule_dict)
+    after = normalise_nat_rule(None, rule_dict)
+    if not rule.is_rule_section and fingerprint(before) == fingerprint(after):
+        return []
+    changes = compare_rules(rule, rule_dict)
+    if changes and diff is not None:
+        diff.update(before=before, after=after)
+    return changes
+
+
 def is_port_range(port):
     """
     If ports are specified and as a port range, then validate
@@ -398,18 +532,25 @@ def get_tag(tag):
             pass
     
 
-class FirewallNATRule(ForcepointModuleBase):
+class FirewallNATRule(RuleOperations, ForcepointModuleBase):
+    normalise = staticmethod(normalise_nat_rule)
+    
     def __init__(self):
         self.module_args = dict(
             policy=dict(type='str'),
             sub_policy=dict(type='str'),
             rules=dict(type='list', default=[]),
-            state=dict(default='present', type='str', choices=['present', 'absent'])
+            state=dict(default='present', type='str', choices=['present', 'absent']),
+            bulk=dict(default=False, type='bool')
         )
         
         self.policy = None
         self.sub_policy = None
         self.rules = None
+        self.rule_index = None
+        self.diff = None
+        self.bulk = False
+        self.check_mode = False
         
         mutually_exclusive = [
             ['policy', 'sub_policy'],
@@ -442,9 +583,18 @@ class FirewallNATRule(ForcepointModuleBase):
             else:
                 policy = FirewallSubPolicy.get(self.sub_policy)
             
+            # NAT rules are listed once, on the first tag lookup. In check
+            # mode the index only plans the operations on the listed rules
+            self.rule_index = RuleIndex(
+                policy.fw_ipv4_nat_rules, check_mode=self.check_mode)
+            if self.check_mode or self.module._diff:
+                self.diff = []
+            
             if state == 'present':
                 
                 self.cache = Cache()
+                # Element references are queued and resolved per type in one pass
+                self.pending_elements = []
                 
                 for rule in self.rules:
                     if 'tag' not in rule and 'name' not in rule:
@@ -508,106 +658,127 @@ class FirewallNATRule(ForcepointModuleBase):
                     
                         if all(k in translated_value for k in ('name', 'type')):
                             # Add elements to cache if defined
-                            self.cache._add_entry(
-                                translated_value.get('type'),
-                                translated_value.get('name'))
+                            self.pending_elements.append({
+                                translated_value.get('type'):
+                                    [translated_value.get('name')]})
+                
+                self.cache.add_many(self.pending_elements)
                                            
                 if self.cache.missing:
                     self.fail(msg='Missing required elements that are referenced in this '
                         'configuration: %s' % self.cache.missing)
                 
-                if self.check_mode:
-                    return self.results
-                
                 # If we've gotten here, cache is populated and we're not missing anything
-                for rule in self.rules:
-                    rule_dict = {}            
-                    
-                    rule_dict.update(
-                        comment=rule.get('comment'),
-                        is_disabled=rule.get('is_disabled', False),
-                        name=rule.get('name'))
-                    
-                    for field in ('sources', 'destinations', 'services'):
-                        rule_dict[field] = self.get_values(rule.get(field, None))
-                    
-                    for nat in nat_type:
-                        if nat in rule:
-                            rule_dict.update(self.nat_definition(nat, rule.get(nat)))
-                                
-                    if 'tag' not in rule:    
-                        rule = policy.fw_ipv4_nat_rules.create(**rule_dict)
+                rule_dicts = [(rule, self.build_rule_dict(rule)) for rule in self.rules]
+                
+                if self.bulk:
+                    # New rules are created first, in blocks
+                    changed = self.create_rules(
+                        [(rule, rule_dict) for rule, rule_dict in rule_dicts
+                         if 'tag' not in rule])
+                
+                for rule, rule_dict in rule_dicts:
+                    if 'tag' not in rule:
+                        if self.bulk:
+                            continue
+                        rule_dict.update(
+                            before=rule.get('add_before'),
+                            after=rule.get('add_after'))
+                        
+                        rule = self.rule_index.create(**rule_dict)
                         changed = True
-                        self.results['state'].append({
-                            'rule': rule.name,
-                            'type': rule.typeof,
-                            'action': 'created'})
+                        self.record(rule, 'created',
+                            after=normalise_nat_rule(None, rule_dict))
                     else:
                         target_rule = self.rule_by_tag(policy, rule.get('tag'))
                         if not target_rule:
                             continue
                         
-                        changes = compare_rules(target_rule, rule_dict)
+                        diff = {}
+                        changes = rule_changes(target_rule, rule_dict, diff)
+                        # Changes have already been merged if any
                         if rule.get('add_after', None):
                             rule_at_pos = self.rule_by_tag(policy, rule.get('add_after'))
                             if rule_at_pos:
-                                target_rule.move_rule_after(rule_at_pos)
+                                target_rule = self.move(
+                                    target_rule, diff, after=rule.get('add_after'))
                                 changes.append('add_after')
                         elif rule.get('add_before', None):
                             rule_at_pos = self.rule_by_tag(policy, rule.get('add_before'))
                             if rule_at_pos:
-                                target_rule.move_rule_before(rule_at_pos)
+                                target_rule = self.move(
+                                    target_rule, diff, before=rule.get('add_before'))
                                 changes.append('add_before')
-                        elif changes:
+                        elif changes and not self.check_mode:
                             target_rule.save()
                         
                         if changes:
                             changed = True
-                            self.results['state'].append({
-                                'rule': target_rule.name,
-                                'type': target_rule.typeof,
-                                'action': 'modified',
-                                'changes': changes})
+                            self.record(target_rule, 'modified', changes, **diff)
             
             elif state == 'absent':
                 for rule in self.rules:
                     if 'tag' in rule:
                         target_rule = self.rule_by_tag(policy, rule.get('tag'))
                         if target_rule:
-                            target_rule.delete()
+                            position = self.position(target_rule)
+                            self.rule_index.delete(target_rule)
                             changed = True
-                            self.results['state'].append({
-                                'rule': target_rule.name,
-                                'type': target_rule.typeof,
-                                'action': 'deleted'})
+                            self.record(target_rule, 'deleted', before=dict(
+                                name=target_rule.name, position=position))
                     
         except SMCException as err:
             self.fail(msg=str(err), exception=traceback.format_exc())
         
         self.results['changed'] = changed
+        if self.diff is not None:
+            self.results['diff'] = self.diff
         return self.results
     
+    def build_rule_dict(self, rule):
+        """
+        Build the NAT rule create constructor arguments from the rule
+        defined in yaml. Referenced elements must already be in the cache.
+        
+        :param dict rule: NAT rule defined in yaml
+        :rtype: dict
+        """
+        rule_dict = {}
+        
+        rule_dict.update(
+            comment=rule.get('comment'),
+            is_disabled=rule.get('is_disabled', False),
+            name=rule.get('name'))
+        
+        for field in ('sources', 'destinations', 'services'):
+            rule_dict[field] = self.get_values(rule.get(field, None))
+        
+        for nat in nat_type:
+            if nat in rule:
+                rule_dict.update(self.nat_definition(nat, rule.get(nat)))
+        return rule_dict
+    
     def rule_by_tag(self, policy, tag):
         """
         Get the rule referenced by it's tag. Tag will be in format
-        '1234566.0'. When doing a search_rule, you must omit the part
-        after the dot(.) to find the rule.
+        '1234566.0'. The revision part after the dot(.) is ignored.
+        Rules are found in the NAT rule index of the policy, which
+        lists the policy NAT rules once per run.
         
         :param FirewallPolicy policy: policy reference
         :param str tag: tag
         :rtype: Rule or None
         """
-        resolved_tag = get_tag(tag)
-        if resolved_tag:
-            rule = policy.search_rule('@{}'.format(resolved_tag))
-            return rule[0] if rule else None
+        if get_tag(tag):
+            return self.rule_index.get(tag)
         
     def field_resolver(self, elements, types):
 
         """
         Field resolver, specific to retrieving network or service level
         elements in different formats. If elements are referencing existing
-        elements, they will be loaded in the cache for retrieval.
+        elements, they are queued in `pending_elements` and loaded in the
+        cache for retrieval once all rules have been parsed.
         
         Format #1, as list (elements are expected to exist):
             - tcp_service:
@@ -653,7 +824,7 @@ class FirewallNATRule(ForcepointModuleBase):
                     self.fail(msg='Elements specified for type: %s should be in list '
                         'format, got: %s' % (name, type(value)))
             
-            self.cache.add_many([elements])
+            self.pending_elements.append(elements)
 
         elif isinstance(elements, list):
             for entry in elements:
@@ -0,0 +1,353 @@
+#!/usr/bin/python
+# Copyright (c) 2017-2019 Forcepoint
+
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+
+DOCUMENTATION = '''
+---
+module: firewall_nat_rule_analysis_facts
+short_description: Find conflicting NAT rules of a firewall policy
+description:
+  - Analyse the NAT rules of a firewall policy, as returned by the
+    firewall_nat_rule_facts module. Source and destination cells and
+    translated addresses are expanded into IP address ranges and service
+    cells into protocol and port ranges, groups being expanded recursively.
+  - Rules conflict when their original source, destination and service
+    overlap while translating to different values. As NAT rules are
+    matched in order, the traffic in common is translated by the earlier
+    rule only.
+  - Static NAT rules collide when different original values are translated
+    to overlapping addresses, and ports for destination NAT. Dynamic source
+    NAT rules overlap when their port pools share addresses and ports.
+  - Rules used on different engines never conflict. Elements that can not
+    be expanded into ranges, like zones, aliases, domain names or
+    expressions, only match themselves. Disabled rules, rule sections and
+    rules with empty cells are not analysed. Rules restricted to source
+    VPNs or validity times never cover later rules.
+  - Rules and translations are indexed with interval trees, so each rule
+    is only compared to the earlier rules it may overlap.
+
+version_added: '2.5'
+
+options:
+  filter:
+    description:
+      - The name of the Firewall Policy to analyse
+    required: true
+    type: str
+  snapshot:
+    description:
+      - Path of a local snapshot of the policy NAT rules. Later runs only
+        fetch the rules that are new or changed since the last run
+    type: str
+
+extends_documentation_fragment:
+  - management_center
+  - management_center_facts
+
+requirements:
+  - smc-python
+author:
+  - Forcepoint
+'''
+
+
+EXAMPLES = '''
+- name: Find conflicting NAT rules in policy TestPolicy
+  firewall_nat_rule_analysis_facts:
+    filter: TestPolicy
+
+- name: Find conflicting NAT rules, reusing a snapshot of the rules
+  firewall_nat_rule_analysis_facts:
+    filter: TestPolicy
+    snapshot: snapshots/TestPolicy_nat_analysis.json
+'''
+
+
+RETURN = '''
+firewall_nat_rule_analysis:
+    description: Conflicting NAT rules of the policy. Each entry is the
+        later rule, with the earlier rules it conflicts with. Positions
+        start at 1 and include rule sections
+    returned: always
+    type: dict
+    sample: {
+        "policy": "TestPolicy",
+        "rules": 3,
+        "opaque_elements": 0,
+        "conflicts": [
+            {
+                "name": "static_dest_nat with IP redirect",
+                "pos": 3,
+                "tag": "2097170.0",
+                "translation": {
+                    "static_dst_nat": [{"ip_descriptor": "1.1.1.2"}]
+                },
+                "rules": [
+                    {
+                        "covers": true,
+                        "name": "static_dest_nat to web server",
+                        "pos": 1,
+                        "tag": "2097168.0",
+                        "translation": {
+                            "static_dst_nat": [{"ip_descriptor": "1.1.1.1"}]
+                        }
+                    }
+                ]
+            }
+        ],
+        "static_collisions": [
+            {
+                "name": "static_src_nat for host-4.4.4.4",
+                "pos": 2,
+                "tag": "2097169.0",
+                "type": "static_src_nat",
+                "rules": [
+                    {
+                        "name": "static_src_nat for host-3.3.3.3",
+                        "pos": 1,
+                        "tag": "2097167.0"
+                    }
+                ]
+            }
+        ],
+        "port_pool_overlaps": [
+            {
+                "name": "dynamic_src_nat for servers",
+                "pos": 5,
+                "tag": "2097172.0",
+                "pool": {"ip_descriptor": "1.1.1.1", "ports": [1024, 65535]},
+                "rules": [
+                    {
+                        "name": "dynamic_src_nat for clients",
+                        "pos": 4,
+                        "tag": "2097171.0",
+                        "pool": {"ip_descriptor": "1.1.1.1", "ports": [1024, 60000]}
+                    }
+                ]
+            }
+        ]
+    }
+'''
+import traceback
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_util import \
+    ForcepointModuleBase, fingerprint
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_rule_analysis import \
+    ElementRanges, Cell, CellIndex, cells, policy_records, nat_translation, address_interval, \
+    overlapping_keys, PORT_SPACE
+
+try:
+    from smc.api.exceptions import SMCException
+    from smc.policy.layer3 import FirewallPolicy
+except ImportError:
+    pass
+
+
+def nat_reference(rule):
+    return {key: rule[key] for key in ('pos', 'name', 'tag')}
+
+
+def used_on(value):
+    # Engine href a rule is used on, None when used on any engine
+    if isinstance(value, dict):
+        return None
+    return value or None
+
+
+def translated_cell(value, ranges):
+    """
+    Addresses of a translated NAT value
+
+    :param dict value: normalised translated value
+    :param ElementRanges ranges: expands elements into ranges
+    :rtype: Cell
+    """
+    if 'element' in value:
+        intervals, opaque = ranges.ranges(value['element'])
+        return Cell(intervals=intervals, opaque=opaque)
+    return Cell(intervals=[address_interval(value['ip_descriptor'])]
+                if value.get('ip_descriptor') else [])
+
+
+def ports_overlap(left, right):
+    # Ports not set stand for any port
+    left = left or (0, PORT_SPACE - 1)
+    right = right or (0, PORT_SPACE - 1)
+    return left[0] <= right[1] and right[0] <= left[1]
+
+
+def analyse_nat(records, ranges):
+    """
+    Find conflicting NAT rules, colliding static NAT translations and
+    overlapping dynamic NAT port pools.
+
+    The original cells of the rules are indexed per cell, as well as
+    the translated addresses of static NAT rules and the address pools
+    of dynamic NAT rules. Only the earlier rules returned by the indexes
+    are compared to each rule.
+
+    :param list records: NAT rule records in policy order
+    :param ElementRanges ranges: expands cells into ranges
+    :rtype: dict
+    """
+    rules = []
+    for pos, record in enumerate(records, 1):
+        if record.get('is_disabled') or not all(record.get(cell) for cell in cells):
+            continue
+        space = tuple(ranges.cell(record[cell]) for cell in cells)
+        if any(cell.is_none for cell in space):
+            continue
+        translation = nat_translation(record.get('nat') or {})
+        rules.append(dict(
+            pos=pos,
+            name=record['name'],
+            tag=record['tag'],
+            used_on=used_on(record.get('used_on')),
+            conditions=record.get('conditions'),
+            space=space,
+            translation=translation,
+            signature=fingerprint(translation)))
+
+    def applies(rule, other):
+        return rule['used_on'] is None or other['used_on'] is None or \
+            rule['used_on'] == other['used_on']
+
+    result = dict(conflicts=[], static_collisions=[], port_pool_overlaps=[])
+
+    # Rules matching common traffic with different translations
+    indexes = [CellIndex((num, rule['space'][dim]) for num, rule in enumerate(rules))
+               for dim in range(len(cells))]
+    for num, rule in enumerate(rules):
+        space = rule['space']
+        candidates = overlapping_keys(indexes, space)
+        if candidates is None:
+            candidates = range(num)
+        related = [rules[key] for key in sorted(candidates) if key < num and
+            rules[key]['signature'] != rule['signature'] and applies(rule, rules[key]) and
+            all(rules[key]['space'][dim].overlaps(space[dim]) for dim in range(len(cells)))]
+        if related:
+            result['conflicts'].append(dict(
+                nat_reference(rule),
+                translation=rule['translation'],
+                rules=[dict(nat_reference(other),
+                            translation=other['translation'],
+                            covers=not other['conditions'] and
+                                all(other['space'][dim].covers(space[dim])
+                                    for dim in range(len(cells))))
+                       for other in related]))
+
+    # Different original values translated to the same static addresses
+    for nat_type, dim in (('static_src_nat', 0), ('static_dst_nat', 1)):
+        static = [(num, translated_cell(rule['translation'][nat_type][0], ranges))
+                  for num, rule in enumerate(rules) if nat_type in rule['translation']]
+        translated = dict(static)
+        index = CellIndex(static)
+        for num, cell in static:
+            if cell.is_none:
+                continue
+            rule = rules[num]
+            ports = rule['translation'][nat_type][0].get('ports')
+            colliding = [rules[key] for key in sorted(index.overlapping(cell))
+                if key < num and applies(rule, rules[key]) and
+                translated[key].overlaps(cell) and
+                ports_overlap(ports, rules[key]['translation'][nat_type][0].get('ports')) and
+                not (rules[key]['space'][dim].covers(rule['space'][dim]) and
+                     rule['space'][dim].covers(rules[key]['space'][dim]))]
+            if colliding:
+                result['static_collisions'].append(dict(
+                    nat_reference(rule),
+                    type=nat_type,
+                    rules=[nat_reference(other) for other in colliding]))
+
+    # Dynamic source NAT pools sharing addresses and ports
+    pools = [(num, value, translated_cell(value, ranges))
+             for num, rule in enumerate(rules)
+             for value in rule['translation'].get('dynamic_src_nat', [])]
+    index = CellIndex((key, pool[2]) for key, pool in enumerate(pools))
+    overlaps = {} # (rule num, pool key): overlapping pools
+    for key, (num, value, cell) in enumerate(pools):
+        if cell.is_none:
+            continue
+        for other in sorted(index.overlapping(cell)):
+            other_num, other_value, other_cell = pools[other]
+            if other_num < num and applies(rules[num], rules[other_num]) and \
+                    other_cell.overlaps(cell) and \
+                    ports_overlap(value.get('ports'), other_value.get('ports')):
+                overlaps.setdefault((num, key), []).append(other)
+    for num, key in sorted(overlaps):
+        result['port_pool_overlaps'].append(dict(
+            nat_reference(rules[num]),
+            pool=pools[key][1],
+            rules=[dict(nat_reference(rules[pools[other][0]]), pool=pools[other][1])
+                   for other in overlaps[(num, key)]]))
+
+    result.update(
+        rules=len(rules),
+        opaque_elements=len(set(href for rule in rules for cell in rule['space']
+                                for href in cell.opaque)))
+    return result
+
+
+class FirewallNATRuleAnalysisFacts(ForcepointModuleBase):
+    def __init__(self):
+
+        self.module_args = dict(
+            filter=dict(type='str', required=True),
+            snapshot=dict(type='str')
+        )
+
+        self.filter = None
+        self.limit = None
+        self.exact_match = None
+        self.case_sensitive = None
+        self.snapshot = None
+
+        self.results = dict(
+            ansible_facts=dict(
+                firewall_nat_rule_analysis={}
+            )
+        )
+        super(FirewallNATRuleAnalysisFacts, self).__init__(self.module_args, is_fact=True)
+
+    def exec_module(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+        try:
+            policy = self.search_by_type(FirewallPolicy)
+            if not policy:
+                self.fail(msg='Policy specified could not be found: %s' % self.filter)
+            elif len(policy) > 1:
+                self.fail(msg='Multiple policies found with the given search filter: %s '
+                    'Use exact_match or case_sensitive to narrow the search' %
+                    [p.name for p in policy])
+
+            policy = policy.pop()
+            records = policy_records(policy.fw_ipv4_nat_rules, self.snapshot)
+            analysis = analyse_nat(records, ElementRanges())
+
+        except SMCException as err:
+            self.fail(msg=str(err), exception=traceback.format_exc())
+        except (IOError, OSError) as err:
+            self.fail(msg='Failed to update the snapshot file: %s' % err,
+                exception=traceback.format_exc())
+        except ValueError as err:
+            self.fail(msg='Invalid NAT translation in policy %s: %s' % (policy.name, err),
+                exception=traceback.format_exc())
+
+        analysis.update(policy=policy.name)
+        self.results['ansible_facts']['firewall_nat_rule_analysis'] = analysis
+        return self.results
+
+
+def main():
+    FirewallNATRuleAnalysisFacts()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+#!/usr/bin/python
+# Copyright (c) 2017-2019 Forcepoint
+
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+
+DOCUMENTATION = '''
+---
+module: firewall_policy_lookup_facts
+short_description: Find the rules of a firewall policy matching connections
+description:
+  - Compile the access and NAT rules of a firewall policy and find the
+    first rule matching each of the given connections, without involving
+    an engine. Use to check the effect of a policy before it is pushed.
+  - Source and destination cells are expanded into IP address ranges and
+    service cells into protocol and port ranges. Jump rules are followed
+    into their sub-policy, continue and disabled rules are ignored.
+  - Rules requiring authentication, restricted to source VPNs or validity
+    times, or referencing elements that can not be expanded, like zones,
+    aliases, domain names or expressions, may match depending on
+    information not known offline. Those rules are returned
+    as undetermined when found before the first matching rule. The engine
+    a NAT rule is used on is not considered.
+
+version_added: '2.5'
+
+options:
+  filter:
+    description:
+      - The name of the Firewall Policy
+    required: true
+    type: str
+  connections:
+    description:
+      - Connections to look up
+    required: true
+    type: list
+    suboptions:
+      src:
+        description:
+          - Source IP address of a single host, networks and ranges are
+            not accepted
+        required: true
+        type: str
+      dst:
+        description:
+          - Destination IP address of a single host, networks and ranges are
+            not accepted
+        required: true
+        type: str
+      protocol:
+        description:
+          - Protocol name, one of tcp, udp, icmp or icmpv6, or protocol number
+        type: str
+        default: tcp
+      dst_port:
+        description:
+          - Destination port, required for tcp and udp
+        type: int
+      icmp_type:
+        description:
+          - ICMP type, for icmp and icmpv6
+        type: int
+      icmp_code:
+        description:
+          - ICMP code, for icmp and icmpv6
+        type: int
+  nat:
+    description:
+      - Also find the first matching NAT rule
+    type: bool
+    default: true
+  snapshot:
+    description:
+      - Path of a local snapshot of the policy rules. Later runs only fetch
+        the rules that are new or changed since the last run
+    type: str
+
+extends_documentation_fragment:
+  - management_center
+  - management_center_facts
+
+requirements:
+  - smc-python
+author:
+  - Forcepoint
+'''
+
+
+EXAMPLES = '''
+- name: Find the rules matching connections in policy TestPolicy
+  firewall_policy_lookup_facts:
+    filter: TestPolicy
+    connections:
+    - src: 10.1.2.3
+      dst: 172.16.0.5
+      protocol: tcp
+      dst_port: 443
+    - src: 10.1.2.3
+      dst: 8.8.8.8
+      protocol: udp
+      dst_port: 53
+    - src: 10.1.2.3
+      dst: 172.16.0.5
+      protocol: icmp
+      icmp_type: 8
+'''
+
+
+RETURN = '''
+firewall_policy_lookup:
+    description: First matching access and NAT rule of each connection.
+        Positions start at 1 and include rule sections
+    returned: always
+    type: dict
+    sample: {
+        "policy": "TestPolicy",
+        "rules": 120,
+        "nat_rules": 12,
+        "connections": [
+            {
+                "src": "10.1.2.3",
+                "dst": "172.16.0.5",
+                "protocol": "tcp",
+                "dst_port": 443,
+                "access_rule": {
+                    "action": "allow",
+                    "name": "web access",
+                    "pos": 12,
+                    "tag": "2097166.2"
+                },
+                "access_undetermined": [],
+                "nat_rule": null,
+                "nat_undetermined": []
+            }
+        ]
+    }
+'''
+import traceback
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_util import \
+    ForcepointModuleBase
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_rule_analysis import \
+    ElementRanges, RuleTable, policy_records, reference, lowest_bits, connection_values
+
+try:
+    from smc.api.exceptions import SMCException
+    from smc.base.model import Element
+    from smc.policy.layer3 import FirewallPolicy
+except ImportError:
+    pass
+
+
+class FirewallPolicyLookupFacts(ForcepointModuleBase):
+    def __init__(self):
+
+        self.module_args = dict(
+            filter=dict(type='str', required=True),
+            connections=dict(type='list', required=True),
+            nat=dict(type='bool', default=True),
+            snapshot=dict(type='str')
+        )
+
+        self.filter = None
+        self.limit = None
+        self.exact_match = None
+        self.case_sensitive = None
+        self.connections = None
+        self.nat = None
+        self.snapshot = None
+        self.ranges = None
+        self.sub_policies = {} # href: RuleTable
+
+        self.results = dict(
+            ansible_facts=dict(
+                firewall_policy_lookup={}
+            )
+        )
+        super(FirewallPolicyLookupFacts, self).__init__(self.module_args, is_fact=True)
+
+    def exec_module(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+        values = []
+        for connection in self.connections:
+            try:
+                values.append(connection_values(connection))
+            except (KeyError, TypeError, ValueError) as err:
+                self.fail(msg='Invalid connection %s, %s. Connections require a '
+                    'src and dst host address, and a protocol and port' % (connection, err))
+
+        try:
+            policy = self.search_by_type(FirewallPolicy)
+            if not policy:
+                self.fail(msg='Policy specified could not be found: %s' % self.filter)
+            elif len(policy) > 1:
+                self.fail(msg='Multiple policies found with the given search filter: %s '
+                    'Use exact_match or case_sensitive to narrow the search' %
+                    [p.name for p in policy])
+
+            policy = policy.pop()
+            # Elements are loaded once for all compiled rules
+            self.ranges = ElementRanges()
+            access = RuleTable(
+                policy_records(policy.fw_ipv4_access_rules, self.snapshot), self.ranges)
+            nat = RuleTable(
+                policy_records(policy.fw_ipv4_nat_rules, self.snapshot), self.ranges) \
+                if self.nat else None
+
+            results = []
+            for connection, value in zip(self.connections, values):
+                result = dict(connection)
+                result['access_rule'], result['access_undetermined'] = \
+                    self.first_match(access, value)
+                if nat:
+                    result['nat_rule'], result['nat_undetermined'] = \
+                        self.first_match(nat, value)
+                results.append(result)
+
+        except SMCException as err:
+            self.fail(msg=str(err), exception=traceback.format_exc())
+        except (IOError, OSError) as err:
+            self.fail(msg='Failed to update the snapshot file: %s' % err,
+                exception=traceback.format_exc())
+
+        self.results['ansible_facts']['firewall_policy_lookup'] = dict(
+            policy=policy.name,
+            rules=len(access.rules),
+            nat_rules=len(nat.rules) if nat else None,
+            connections=results)
+        return self.results
+
+    def first_match(self, table, value, seen=()):
+        """
+        First rule of the table matching the connection. A matching jump
+        rule is followed into its sub-policy, the lookup continuing after
+        the jump rule if no rule of the sub-policy matches.
+
+        :param RuleTable table: compiled rules
+        :param tuple value: values of the connection
+        :param tuple seen: sub-policies being looked up
+        :return: matching rule or None, and the rules that may match
+            before it
+        :rtype: tuple
+        """
+        match, possible = table.lookup(value)
+        undetermined = []
+        for num in lowest_bits(possible):
+            rule = table.rules[num]
+            if not match >> num & 1:
+                undetermined.append(reference(rule))
+                continue
+            if rule['action'] == 'jump':
+                if not rule['sub_policy'] or rule['sub_policy'] in seen:
+                    continue
+                found, sub_undetermined = self.first_match(
+                    self.sub_policy(rule['sub_policy']), value,
+                    seen + (rule['sub_policy'],))
+                undetermined.extend(dict(entry, jump=reference(rule))
+                                    for entry in sub_undetermined)
+                if found:
+                    return dict(found, jump=reference(rule)), undetermined
+                continue
+            return reference(rule), undetermined
+        return None, undetermined
+
+    def sub_policy(self, href):
+        """
+        Compiled rules of a sub-policy, compiled once per run
+
+        :param str href: href of the sub-policy
+        :rtype: RuleTable
+        """
+        if href not in self.sub_policies:
+            sub_policy = Element.from_href(href)
+            self.sub_policies[href] = RuleTable(
+                policy_records(sub_policy.fw_ipv4_access_rules, self.snapshot), self.ranges)
+        return self.sub_policies[href]
+
+
+def main():
+    FirewallPolicyLookupFacts()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,649 @@
+#!/usr/bin/python
+# Copyright (c) 2017-2019 Forcepoint
+
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+
+DOCUMENTATION = '''
+---
+module: firewall_policy_partition
+short_description: Partition a firewall policy into sub-policies
+description:
+  - Analyse the access rules of a firewall policy and propose moving rules
+    into sub-policies, grouped by destination network block or destination
+    zone. Each group of rules is replaced in the policy by a single jump
+    rule matching the block or zone, so connections to other destinations
+    skip the rules of the group.
+  - A rule joins a group when its destinations are all within the block,
+    or are the zone. The jump rule is placed at the first rule of the
+    group, and later rules only join the group when they can never match
+    the same connections as the rules they are moved ahead of. Rules keep
+    their relative order within a group, so connections are matched by the
+    same rules once the policy is partitioned.
+  - When I(traffic) is given, the connections are looked up in the policy
+    before and after partitioning, the same way as firewall_policy_lookup_facts.
+    The average number of rules evaluated for the connections is returned,
+    and the matching rules are verified to be the same. Disabled rules,
+    rule sections and continue rules are not counted.
+  - Set I(apply) to create the sub-policies and jump rules and to move the
+    rules. The jump rules are also returned in the format of the
+    firewall_rule module.
+  - Connections only carry addresses, so the zones they match are not known
+    offline. When grouping by zone, the partition is only proposed and the
+    I(traffic) and I(apply) options are rejected.
+
+version_added: '2.5'
+
+options:
+  policy:
+    description:
+      - The name of the Firewall Policy to partition
+    required: true
+    type: str
+  group_by:
+    description:
+      - Group rules by destination network block or by destination zone
+    type: str
+    default: network
+    choices:
+      - network
+      - zone
+  blocks:
+    description:
+      - Network blocks in CIDR notation to group rules by, when grouping by
+        network. A rule is grouped in the smallest block containing all of
+        its destinations. When not set, blocks are formed automatically
+        with I(prefix_length)
+    type: list
+  prefix_length:
+    description:
+      - Prefix length of the automatic IPv4 network blocks
+    type: int
+    default: 16
+  ipv6_prefix_length:
+    description:
+      - Prefix length of the automatic IPv6 network blocks
+    type: int
+    default: 48
+  min_rules:
+    description:
+      - Minimum number of rules of a group to move it into a sub-policy
+    type: int
+    default: 10
+  sub_policy_prefix:
+    description:
+      - Prefix of the names of the sub-policies, followed by the block or zone
+        name. Defaults to the policy name
+    type: str
+  traffic:
+    description:
+      - Sample of connections used to estimate the number of rules evaluated
+        and verify the matching rules. Connections are specified as in the
+        firewall_policy_lookup_facts module. Not supported when grouping
+        by zone
+    type: list
+  apply:
+    description:
+      - Create the sub-policies and jump rules and move the rules of the
+        groups. Sub-policies must not exist already. Network elements for the
+        blocks are created when missing. Nothing is applied when the sample
+        traffic is not matched by the same rules. Not supported when grouping
+        by zone
+    type: bool
+    default: false
+  snapshot:
+    description:
+      - Path of a local snapshot of the policy rules. Later runs only fetch
+        the rules that are new or changed since the last run
+    type: str
+
+extends_documentation_fragment: management_center
+
+requirements:
+  - smc-python
+author:
+  - Forcepoint
+'''
+
+
+EXAMPLES = '''
+- name: Propose sub-policies per /16 destination network of TestPolicy
+  firewall_policy_partition:
+    policy: TestPolicy
+    prefix_length: 16
+    min_rules: 20
+    traffic:
+    - src: 10.1.2.3
+      dst: 172.16.0.5
+      protocol: tcp
+      dst_port: 443
+    - src: 10.1.2.3
+      dst: 192.168.10.20
+      protocol: udp
+      dst_port: 53
+
+- name: Propose sub-policies per destination zone
+  firewall_policy_partition:
+    policy: TestPolicy
+    group_by: zone
+
+- name: Move the rules of each destination network block into a sub-policy
+  firewall_policy_partition:
+    policy: TestPolicy
+    blocks:
+    - 172.16.0.0/16
+    - 192.168.0.0/16
+    apply: true
+'''
+
+
+RETURN = '''
+changed:
+  description: Whether or not the policy was partitioned
+  returned: always
+  type: bool
+partition:
+    description: Proposed sub-policies, with the rules moved into each of
+        them. Positions start at 1 and include rule sections
+    returned: always
+    type: dict
+    sample: {
+        "policy": "TestPolicy",
+        "rules": 1200,
+        "rules_after": 310,
+        "groups": [
+            {
+                "sub_policy": "TestPolicy 172.16.0.0/16",
+                "block": "172.16.0.0/16",
+                "position": 12,
+                "rules": [
+                    {
+                        "action": "allow",
+                        "name": "web access",
+                        "pos": 12,
+                        "tag": "2097166.2"
+                    }
+                ],
+                "jump_rule": {
+                    "name": "TestPolicy 172.16.0.0/16",
+                    "action": "jump",
+                    "sub_policy": "TestPolicy 172.16.0.0/16",
+                    "sources": {"any": true},
+                    "destinations": {"network": ["net-172.16.0.0/16"]},
+                    "services": {"any": true},
+                    "add_before": "2097166.2"
+                }
+            }
+        ],
+        "traffic": {
+            "connections": 2,
+            "average_before": 640.5,
+            "average_after": 155.0,
+            "reduction": 0.758,
+            "identical": true,
+            "differences": []
+        }
+    }
+'''
+import ipaddress
+import traceback
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_util import \
+    ForcepointModuleBase, RuleIndex, HrefResolver
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_rule_analysis import \
+    ElementRanges, Cell, RuleTable, policy_records, reference, lowest_bits, connection_values, \
+    address_interval, cells_disjoint, spaces_disjoint, cells, non_terminating, IPV6_OFFSET
+
+try:
+    from smc.api.exceptions import SMCException, CreateRuleFailed
+    from smc.base.model import Element, ElementCreator
+    from smc.elements.network import Network
+    from smc.policy.layer3 import FirewallPolicy, FirewallSubPolicy
+except ImportError:
+    pass
+
+
+# Rule fields set by the SMC, not copied when a rule is moved to a sub-policy
+server_fields = ('key', 'link', 'parent_policy', 'rank', 'tag')
+
+
+def network_block(cell, blocks=None, prefix_length=16, ipv6_prefix_length=48):
+    """
+    Network block containing all values of a destination cell. This is
+    the smallest of the blocks containing the cell when blocks are given,
+    otherwise the network of the given prefix length.
+
+    :param Cell cell: destination cell
+    :param list blocks: (label, interval) tuples, smallest first
+    :return: (label, interval) or None if the cell is in no block
+    :rtype: tuple
+    """
+    if cell.any or cell.opaque or not cell.intervals:
+        return None
+    first, last = cell.intervals[0][0], cell.intervals[-1][1]
+    if blocks:
+        for label, interval in blocks:
+            if interval[0] <= first and last <= interval[1]:
+                return label, interval
+        return None
+    if first >= IPV6_OFFSET:
+        bits, length, offset, address = 128, ipv6_prefix_length, IPV6_OFFSET, ipaddress.IPv6Address
+    else:
+        bits, length, offset, address = 32, prefix_length, 0, ipaddress.IPv4Address
+    size = 1 << (bits - length)
+    block_first = (first - offset) // size * size + offset
+    if last > block_first + size - 1:
+        return None
+    return ('%s/%d' % (address(block_first - offset), length),
+            (block_first, block_first + size - 1))
+
+
+def zone_block(cell):
+    """
+    Zone of a destination cell matching a single zone
+
+    :param Cell cell: destination cell
+    :return: (zone href, None) or None
+    :rtype: tuple
+    """
+    if cell.any or cell.intervals or len(cell.opaque) != 1:
+        return None
+    href = next(iter(cell.opaque))
+    if HrefResolver.typeof(href) == 'interface_zone':
+        return href, None
+
+
+def partition(records, ranges, block_of, min_rules=10):
+    """
+    Group the rules of a policy by destination block.
+
+    Rules are visited in policy order. A rule joins the open group of its
+    block when it can never match the same connections as the rules seen
+    since the first rule of the group whose destinations may overlap the
+    block, as it is moved ahead of those rules. Otherwise the group is
+    closed and a new group is opened with the rule. Rules that may
+    overlap the block of an open group without joining it are kept for
+    that group. Jump and continue rules never join a group.
+
+    :param list records: rule records in policy order
+    :param ElementRanges ranges: expands cells into ranges
+    :param callable block_of: returns the (key, interval) block of a
+        destination cell, or None
+    :param int min_rules: minimum number of rules of a group
+    :return: groups in order of their first rule, each with the block
+        key, interval, cell and rules
+    :rtype: list
+    """
+    groups = []
+    open_groups = {} # block key: group
+    for pos, record in enumerate(records, 1):
+        if record.get('is_disabled') or not all(record.get(cell) for cell in cells):
+            continue
+        space = tuple(ranges.cell(record[cell]) for cell in cells)
+        if any(cell.is_none for cell in space):
+            continue
+        rule = dict(
+            pos=pos,
+            name=record['name'],
+            tag=record['tag'],
+            action=record['action'],
+            space=space,
+            record=record)
+
+        joined = None
+        block = block_of(space[1]) if record['action'] not in non_terminating else None
+        if block is not None:
+            key, interval = block
+            group = open_groups.get(key)
+            if group is not None and all(spaces_disjoint(space, other['space'])
+                                         for other in group['barrier']):
+                group['rules'].append(rule)
+                joined = group
+            else:
+                joined = dict(
+                    key=key,
+                    interval=interval,
+                    cell=Cell(intervals=[interval]) if interval else Cell(opaque=[key]),
+                    rules=[rule],
+                    barrier=[])
+                open_groups[key] = joined
+                groups.append(joined)
+
+        for group in open_groups.values():
+            if group is not joined and not cells_disjoint(space[1], group['cell']):
+                group['barrier'].append(rule)
+
+    for group in groups:
+        group.pop('barrier')
+    return [group for group in groups if len(group['rules']) >= min_rules]
+
+
+def layout(records, groups):
+    """
+    Records of the policy once partitioned, each group being replaced by
+    a jump rule at the position of its first rule
+
+    :param list records: rule records in policy order
+    :param list groups: groups with their `jump` record
+    :rtype: list
+    """
+    jumps = {group['rules'][0]['pos']: group['jump'] for group in groups}
+    moved = set(rule['pos'] for group in groups for rule in group['rules'])
+    partitioned = []
+    for pos, record in enumerate(records, 1):
+        if pos in jumps:
+            partitioned.append(jumps[pos])
+        if pos not in moved:
+            partitioned.append(record)
+    return partitioned
+
+
+def evaluate(table, value, sub_policy, seen=()):
+    """
+    Rule deciding a connection and the number of rules evaluated. Jump
+    rules are followed into their sub-policy, the lookup continuing
+    after the jump rule if no rule of the sub-policy matches.
+
+    :param RuleTable table: compiled rules
+    :param tuple value: values of the connection
+    :param callable sub_policy: returns the RuleTable of a sub-policy
+    :param tuple seen: sub-policies being looked up
+    :return: deciding rule or None, and the number of rules evaluated
+    :rtype: tuple
+    """
+    match, _possible = table.lookup(value)
+    evaluated = 0
+    for num in lowest_bits(match):
+        rule = table.rules[num]
+        if rule['action'] == 'jump':
+            if not rule['sub_policy'] or rule['sub_policy'] in seen:
+                continue
+            found, count = evaluate(sub_policy(rule['sub_policy']), value, sub_policy,
+                                    seen + (rule['sub_policy'],))
+            evaluated += count
+            if found:
+                return found, evaluated + num + 1
+            continue
+        return rule, evaluated + num + 1
+    return None, evaluated + len(table.rules)
+
+
+class FirewallPolicyPartition(ForcepointModuleBase):
+    def __init__(self):
+
+        self.module_args = dict(
+            policy=dict(type='str', required=True),
+            group_by=dict(type='str', default='network', choices=['network', 'zone']),
+            blocks=dict(type='list', default=[]),
+            prefix_length=dict(type='int', default=16),
+            ipv6_prefix_length=dict(type='int', default=48),
+            min_rules=dict(type='int', default=10),
+            sub_policy_prefix=dict(type='str'),
+            traffic=dict(type='list', default=[]),
+            apply=dict(type='bool', default=False),
+            snapshot=dict(type='str')
+        )
+
+        self.policy = None
+        self.group_by = None
+        self.blocks = None
+        self.prefix_length = None
+        self.ipv6_prefix_length = None
+        self.min_rules = None
+        self.sub_policy_prefix = None
+        self.traffic = None
+        self.apply = None
+        self.snapshot = None
+        self.ranges = None
+        self.sub_policies = {} # href: RuleTable
+
+        self.results = dict(
+            changed=False,
+            partition={}
+        )
+        super(FirewallPolicyPartition, self).__init__(self.module_args,
+            supports_check_mode=True)
+
+    def exec_module(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+        if not 0 <= self.prefix_length <= 32 or not 0 <= self.ipv6_prefix_length <= 128:
+            self.fail(msg='Invalid prefix length, IPv4 prefix length must be between '
+                '0-32 and IPv6 prefix length between 0-128')
+
+        blocks = []
+        for block in self.blocks:
+            try:
+                label = str(ipaddress.ip_network(u'%s' % block, strict=False))
+                blocks.append((label, address_interval(label)))
+            except ValueError as err:
+                self.fail(msg='Invalid network block %s: %s' % (block, err))
+        blocks.sort(key=lambda block: block[1][1] - block[1][0])
+
+        values = []
+        for connection in self.traffic:
+            try:
+                values.append(connection_values(connection))
+            except (KeyError, TypeError, ValueError) as err:
+                self.fail(msg='Invalid connection %s, %s. Connections require a '
+                    'src and dst host address, and a protocol and port' % (connection, err))
+
+        if self.group_by == 'zone':
+            # Zones of a connection are not known offline, so the policy
+            # can not be verified to match the same rules once partitioned
+            if self.traffic or self.apply:
+                self.fail(msg='The traffic and apply options are not supported when '
+                    'grouping by zone, as the matching rules can not be verified')
+            block_of = zone_block
+        else:
+            block_of = lambda cell: network_block(
+                cell, blocks, self.prefix_length, self.ipv6_prefix_length)
+
+        changed = False
+        try:
+            policy = FirewallPolicy.get(self.policy)
+            records = policy_records(policy.fw_ipv4_access_rules, self.snapshot)
+            self.ranges = ElementRanges()
+            groups = partition(records, self.ranges, block_of, self.min_rules)
+            self.name_groups(groups)
+
+            before = RuleTable(records, self.ranges)
+            after = RuleTable(layout(records, groups), self.ranges)
+            for num, group in enumerate(groups):
+                self.sub_policies['partition:%d' % num] = RuleTable(
+                    [rule['record'] for rule in group['rules']], self.ranges)
+
+            traffic = self.compare(before, after, values) if values else None
+            if self.apply and groups:
+                if traffic and not traffic['identical']:
+                    self.fail(msg='Connections of the traffic sample are not matched by the '
+                        'same rules once partitioned, the policy was not changed: %s'
+                        % traffic['differences'])
+                if not self.check_mode:
+                    self.apply_partition(policy, groups)
+                changed = True
+
+        except SMCException as err:
+            self.fail(msg=str(err), exception=traceback.format_exc())
+        except (IOError, OSError) as err:
+            self.fail(msg='Failed to update the snapshot file: %s' % err,
+                exception=traceback.format_exc())
+
+        self.results['changed'] = changed
+        self.results['partition'] = dict(
+            policy=policy.name,
+            rules=len(before.rules),
+            rules_after=len(after.rules),
+            groups=[dict(
+                sub_policy=group['sub_policy'],
+                block=group['label'],
+                position=group['rules'][0]['pos'],
+                rules=[reference(rule) for rule in group['rules']],
+                jump_rule=group['jump_rule']) for group in groups],
+            traffic=traffic)
+        return self.results
+
+    def name_groups(self, groups):
+        """
+        Name the sub-policy of each group after its block or zone and
+        define its jump rule, as a rule record and in the firewall_rule
+        module format
+
+        :param list groups: groups returned by `partition`
+        """
+        resolver = HrefResolver()
+        resolver.add([group['key'] for group in groups if group['interval'] is None])
+        resolver.resolve()
+        prefix = self.sub_policy_prefix or self.policy
+        names = {}
+        for num, group in enumerate(groups):
+            if group['interval'] is None:
+                label = resolver.get(group['key'])[1]
+                href = group['key']
+                destinations = {'interface_zone': [label]}
+            else:
+                label = group['key']
+                href = 'partition:%s' % label
+                self.ranges.add(href, [group['interval']])
+                destinations = {'network': ['net-%s' % label]}
+
+            # A block split in several groups gets numbered sub-policies
+            name = '%s %s' % (prefix, label)
+            names[name] = names.get(name, 0) + 1
+            if names[name] > 1:
+                name = '%s (%d)' % (name, names[name])
+            group.update(
+                label=label,
+                sub_policy=name,
+                jump=dict(
+                    name=name,
+                    tag=None,
+                    is_disabled=False,
+                    action='jump',
+                    sub_policy='partition:%d' % num,
+                    sources={'any': True},
+                    destinations={'dst': [href]},
+                    services={'any': True}))
+            group['jump_rule'] = dict(
+                name=group['sub_policy'],
+                action='jump',
+                sub_policy=group['sub_policy'],
+                sources={'any': True},
+                destinations=destinations,
+                services={'any': True},
+                add_before=group['rules'][0]['tag'])
+
+    def compare(self, before, after, values):
+        """
+        Look up the connections in the policy before and after partitioning
+
+        :param RuleTable before: compiled rules of the policy
+        :param RuleTable after: compiled rules of the partitioned policy
+        :param list values: values of the connections
+        :return: average rules evaluated and connections matched by
+            different rules
+        :rtype: dict
+        """
+        evaluated_before = evaluated_after = 0
+        differences = []
+        for connection, value in zip(self.traffic, values):
+            rule_before, count_before = evaluate(before, value, self.sub_policy)
+            rule_after, count_after = evaluate(after, value, self.sub_policy)
+            evaluated_before += count_before
+            evaluated_after += count_after
+            if (rule_before or {}).get('tag') != (rule_after or {}).get('tag'):
+                differences.append(dict(
+                    connection,
+                    before=reference(rule_before) if rule_before else None,
+                    after=reference(rule_after) if rule_after else None))
+
+        average_before = float(evaluated_before) / len(values)
+        average_after = float(evaluated_after) / len(values)
+        return dict(
+            connections=len(values),
+            average_before=round(average_before, 2),
+            average_after=round(average_after, 2),
+            reduction=round(1 - average_after / average_before, 3) if average_before else 0.0,
+            identical=not differences,
+            differences=differences)
+
+    def sub_policy(self, href):
+        """
+        Compiled rules of a sub-policy, compiled once per run
+
+        :param str href: href of the sub-policy
+        :rtype: RuleTable
+        """
+        if href not in self.sub_policies:
+            sub_policy = Element.from_href(href)
+            self.sub_policies[href] = RuleTable(
+                policy_records(sub_policy.fw_ipv4_access_rules, self.snapshot), self.ranges)
+        return self.sub_policies[href]
+
+    def apply_partition(self, policy, groups):
+        """
+        Create the sub-policy of each group, copy the rules of the group
+        into it in order, add the jump rule before the first rule of the
+        group and delete the rules from the policy. The policy is only
+        validated with the last jump rule.
+
+        :param FirewallPolicy policy: policy to partition
+        :param list groups: named groups
+        """
+        existing = [group['sub_policy'] for group in groups
+                    if FirewallSubPolicy.get(group['sub_policy'], raise_exc=False)]
+        if existing:
+            self.fail(msg='Sub-policies already exist: %s' % existing)
+
+        rule_index = RuleIndex(policy.fw_ipv4_access_rules)
+        for num, group in enumerate(groups, 1):
+            rules = [rule_index.get(rule['tag']) for rule in group['rules']]
+            if not all(rules):
+                self.fail(msg='Rules of the policy changed during the analysis, '
+                    'run the module again')
+
+            sub_policy = FirewallSubPolicy.create(group['sub_policy'])
+            # Rules added without a position are inserted at the top
+            for rule in reversed(rules):
+                ElementCreator(
+                    rule.__class__,
+                    json={key: value for key, value in rule.data.items()
+                          if key not in server_fields},
+                    exception=CreateRuleFailed,
+                    href=sub_policy.fw_ipv4_access_rules.href,
+                    params={'validate': False})
+
+            if group['interval'] is None:
+                destination = group['key']
+            elif ':' in group['label']:
+                destination = Network.get_or_create(
+                    filter_key={'ipv6_network': group['label']},
+                    name='net-%s' % group['label'], ipv6_network=group['label'])
+            else:
+                destination = Network.get_or_create(
+                    filter_key={'ipv4_network': group['label']},
+                    name='net-%s' % group['label'], ipv4_network=group['label'])
+
+            rule_index.create(
+                name=group['sub_policy'],
+                sources='any',
+                destinations=[destination],
+                services='any',
+                action='jump',
+                sub_policy=sub_policy,
+                before=group['rules'][0]['tag'],
+                validate=num == len(groups))
+            for rule in rules:
+                rule_index.delete(rule)
+
+
+def main():
+    FirewallPolicyPartition()
+
+if __name__ == '__main__':
+    main()
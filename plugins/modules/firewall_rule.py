@@ -18,6 +18,9 @@ description:
     referenced by their type and name (they must be pre-created). Many other
     rule settings are possible, including logging, inspection and connection
     tracking settings. 
+  - In check mode, rules are listed once and the operations are planned
+    against the listed rules without any write to the SMC. The planned
+    operations are returned in the state and the diff of the results.
 
 version_added: '2.5'
 
@@ -334,12 +337,29 @@ options:
         type: str
   state:
     description:
-      - Create or delete a firewall cluster
+      - Create or delete a firewall cluster. With C(replaced), I(rules) is the full
+        ordered list of rules of the policy. Rules are matched to existing rules by tag,
+        or by name when no tag is set, a tag that is not in the policy is an error.
+        Only the changes needed are applied, existing
+        rules not in the list are deleted, missing rules are created and rules out of
+        order are moved.
     required: false
     default: present
     choices:
       - present
       - absent
+      - replaced
+  bulk:
+    description:
+      - Create new rules in bulk. New rules are created before changes to existing
+        rules are applied and are placed in the order they are defined. A rule without
+        I(add_after) or I(add_before) follows the previous new rule, and the first new
+        rules are placed at the top of the policy. Rules are inserted without
+        validation, the policy being validated once with the last rule. Use this when
+        importing many rules.
+    required: false
+    default: false
+    type: bool
     
 '''
 
@@ -473,6 +493,55 @@ EXAMPLES = '''
         name: my deny
         add_after: '2097193.0'
 
+- name: Import rules in bulk, in this order after the specified rule
+  firewall_rule:
+    policy: TestPolicy
+    bulk: true
+    rules:
+    -   action: allow
+        name: allow web
+        add_after: '2097193.0'
+        services:
+            tcp_service:
+            - HTTP
+            - HTTPS
+        sources:
+            any: true
+        destinations:
+            any: true
+    -   action: discard
+        name: deny all
+        services:
+            any: true
+        sources:
+            any: true
+        destinations:
+            any: true
+
+- name: Make the policy contain exactly these rules, in this order
+  firewall_rule:
+    policy: TestPolicy
+    state: replaced
+    rules:
+    -   action: allow
+        name: allow web
+        services:
+            tcp_service:
+            - HTTP
+            - HTTPS
+        sources:
+            any: true
+        destinations:
+            any: true
+    -   action: discard
+        name: deny all
+        services:
+            any: true
+        sources:
+            any: true
+        destinations:
+            any: true
+
 - name: Delete a rule
   firewall_rule:
     policy: TestPolicy
@@ -490,6 +559,12 @@ state:
   description: The current state of the element
   return: always
   type: dict
+diff:
+  description: Rules before and after each operation, with the position of
+    moved and deleted rules. Only the fields set in the rule definition are
+    compared
+  returned: check mode or diff mode
+  type: list
 '''
 
 import traceback
@@ -497,7 +572,8 @@ from ansible.module_utils.six import integer_types
 from ansible.module_utils.six import string_types
 
 from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_util \
-    import (ForcepointModuleBase, Cache, is_sixdotsix_compat)
+    import (ForcepointModuleBase, Cache, RuleIndex, RuleOperations, is_sixdotsix_compat,
+        longest_increasing_subsequence, fingerprint, normalise_cell)
 
 
 try:
@@ -742,6 +818,86 @@ def compare_rules(rule, rule_dict):
     return changes
 
 
+def _action(value):
+    return sorted(set(value)) if isinstance(value, list) else value
+
+
+def normalise_rule(data, rule_dict):
+    """
+    Normalised form of a rule for the fields compared by `compare_rules`.
+    Only the settings specified in the rule dict are considered, so the
+    rule as defined in yaml and the rule fetched from the SMC have the
+    same form when `compare_rules` would find no change.
+    
+    :param dict data: rule json, or None to normalise the rule dict
+    :param dict rule_dict: rule dict from yaml, matching the create
+        constructor args
+    :rtype: dict
+    """
+    desired = data is None
+    if desired:
+        data = {}
+    action = data.get('action', {})
+    auth = data.get('authentication_options', {})
+    yaml_action = rule_dict.get('action')
+    yaml_auth = rule_dict.get('authentication_options')
+    
+    rule = dict(
+        is_disabled=rule_dict.get('is_disabled') if desired else data.get('is_disabled'),
+        name=rule_dict.get('name') if desired else data.get('name'),
+        action=_action(yaml_action.action if desired else action.get('action')))
+    
+    if 'comment' in rule_dict:
+        rule.update(comment=rule_dict['comment'] if desired else data.get('comment'))
+    
+    for field, values in (('log_options', data.get('options', {})),
+                          ('connection_tracking', action.get('connection_tracking_options', {}))):
+        if field in rule_dict:
+            rule[field] = {name: value if desired else values.get(name)
+                           for name, value in rule_dict[field].items()}
+    
+    if yaml_auth is not None:
+        auth = yaml_auth.data if desired else auth
+        rule.update(authentication_options=dict(
+            require_auth=auth.get('require_auth'),
+            users=sorted(set(auth.get('users', []))),
+            methods=sorted(set(auth.get('methods', [])))))
+    
+    for field in inspection_options:
+        if field in yaml_action:
+            rule[field] = yaml_action[field] if desired else action.get(field)
+    
+    for field in ('sources', 'destinations', 'services'):
+        rule[field] = normalise_cell(rule_dict.get(field) if desired else data.get(field))
+    
+    return rule
+
+
+def rule_changes(rule, rule_dict, diff=None):
+    """
+    Compare a fingerprint of the rule fetched from the policy to the
+    fingerprint of the rule dict first. Only when the fingerprints
+    differ is the rule walked with `compare_rules`, which merges the
+    changes in the rule. Rule sections are always compared.
+    
+    :param IPv4Rule rule: rule fetched from policy
+    :param dict rule_dict: rule dict from yaml, matching the create
+        constructor args
+    :param dict diff: updated with the normalised rule before and after
+        the changes when provided
+    :return: list of changes
+    :rtype: list
+    """
+    before = normalise_rule(rule.data, rule_dict)
+    after = normalise_rule(None, rule_dict)
+    if not rule.is_rule_section and fingerprint(before) == fingerprint(after):
+        return []
+    changes = compare_rules(rule, rule_dict)
+    if changes and diff is not None:
+        diff.update(before=before, after=after)
+    return changes
+
+
 def get_tag(tag):
     """
     Get the rule tag. Used by the search function that needs
@@ -758,19 +914,25 @@ def get_tag(tag):
             pass
         
 
-class FirewallRule(ForcepointModuleBase):
+class FirewallRule(RuleOperations, ForcepointModuleBase):
+    normalise = staticmethod(normalise_rule)
+    
     def __init__(self):
         
         self.module_args = dict(
             policy=dict(type='str'),
             sub_policy=dict(type='str'),
             rules=dict(type='list', default=[]),
-            state=dict(default='present', type='str', choices=['present', 'absent'])
+            state=dict(default='present', type='str', choices=['present', 'absent', 'replaced']),
+            bulk=dict(default=False, type='bool')
         )
         
         self.policy = None
         self.sub_policy = None
         self.rules = None
+        self.rule_index = None
+        self.diff = None
+        self.bulk = False
         self.check_mode = False
         
         mutually_exclusive = [
@@ -804,7 +966,14 @@ class FirewallRule(ForcepointModuleBase):
             else:
                 policy = FirewallSubPolicy.get(self.sub_policy)
             
-            if state == 'present':
+            # Rules are listed once, on the first tag lookup. In check mode
+            # the index only plans the operations on the listed rules
+            self.rule_index = RuleIndex(
+                policy.fw_ipv4_access_rules, check_mode=self.check_mode)
+            if self.check_mode or self.module._diff:
+                self.diff = []
+            
+            if state in ('present', 'replaced'):
                 
                 for rule in self.rules:
                     try:
@@ -813,6 +982,8 @@ class FirewallRule(ForcepointModuleBase):
                         self.fail(msg=str(e))
         
                 self.cache = Cache()
+                # Element references are queued and resolved per type in one pass
+                self.pending_elements = []
 
                 for rule in self.rules:
                     # Resolve elements if they exist, calls to SMC could happen here
@@ -840,87 +1011,37 @@ class FirewallRule(ForcepointModuleBase):
                             for accounts in ('users', 'groups'):
                                 self.cache._add_user_entries(accounts, auth.get(accounts, []))
 
+                self.cache.add_many(self.pending_elements)
+
                 if self.cache.missing:
                     self.fail(msg='Missing required elements that are referenced in this '
                         'configuration: %s' % self.cache.missing)
                 
-                if self.check_mode:
-                    return self.results
+                rule_dicts = [(rule, self.build_rule_dict(rule)) for rule in self.rules]
                 
-                for rule in self.rules:
-                    rule_dict = {}
+                if state == 'replaced':
+                    changed = self.replace_rules(rule_dicts)
+                    rule_dicts = [] # All changes are applied
                 
-                    if 'log_options' in rule:
-                        log_options = LogOptions()
-                        log_options.update(rule.get('log_options', {}))
-                        rule_dict.update(log_options=log_options)
-
-                    if 'connection_tracking' in rule:
-                        connection_tracking = ConnectionTracking()
-                        _ct = rule['connection_tracking']
-                        for name, value in connection_tracking.items():
-                            if name not in _ct:
-                                connection_tracking.pop(name)
-            
-                        connection_tracking.update(rule.get('connection_tracking',{}))
-                        rule_dict.update(connection_tracking=connection_tracking)
-                    
-                    action = Action() # If no action, set to default based on version
-                    if 'action' not in rule:
-                        action.action = 'allow' if not is_sixdotsix_compat() else ['allow']
-                    else:
-                        action.action = rule.get('action')
-                    
-                    if 'inspection_options' in rule:
-                        _inspection = rule['inspection_options']
-                        for option in inspection_options:
-                            if option in _inspection:
-                                action[option] = _inspection.get(option)
-                    
-                    if 'authentication_options' in rule:
-                        _auth_options = rule['authentication_options']
-                        auth_options = AuthenticationOptions()
-                        
-                        if _auth_options.get('require_auth'):
-                            auth_options.update(methods=[
-                                self.get_value('authentication_service', m).href
-                                for m in _auth_options.get('methods', [])],
-                            require_auth=True)
-                            
-                            auth_options.update(users=[entry.href
-                                for entry in self.cache.get_type('user_element')])
-
-                        rule_dict.update(authentication_options=auth_options)
-                    
-                    rule_dict.update(action=action)
-                    
-                    for field in ('sources', 'destinations', 'services'):
-                        rule_dict[field] = self.get_values(rule.get(field, None))
-
-                    rule_dict.update(
-                        vpn_policy=self.get_value('vpn', rule.get('vpn_policy')),
-                        sub_policy=self.get_value('sub_ipv4_fw_policy', rule.get('sub_policy')),
-                        mobile_vpn=rule.get('mobile_vpn', False))
-                    
-                    if 'comment' in rule:
-                        rule_dict.update(comment=rule.get('comment'))
-                    
-                    rule_dict.update(
-                        name=rule.get('name'),
-                        is_disabled=rule.get('is_disabled', False))
-                    
+                elif self.bulk:
+                    # New rules are created first, in blocks
+                    changed = self.create_rules(
+                        [(rule, rule_dict) for rule, rule_dict in rule_dicts
+                         if 'tag' not in rule])
+                
+                for rule, rule_dict in rule_dicts:
                     if 'tag' not in rule:
+                        if self.bulk:
+                            continue
                         # If no tag is present, this is a create
                         rule_dict.update(
                             before=rule.get('add_before'),
                             after=rule.get('add_after'))
                         
-                        rule = policy.fw_ipv4_access_rules.create(**rule_dict)
+                        rule = self.rule_index.create(**rule_dict)
                         changed = True
-                        self.results['state'].append({
-                            'rule': rule.name,
-                            'type': rule.typeof,
-                            'action': 'created'})
+                        self.record(rule, 'created',
+                            after=normalise_rule(None, rule_dict))
                     
                     else:
                         # Modify as rule has 'tag' defined. Fetch the rule first
@@ -929,67 +1050,237 @@ class FirewallRule(ForcepointModuleBase):
                         if not target_rule:
                             continue
 
-                        changes = compare_rules(target_rule, rule_dict)
+                        diff = {}
+                        changes = rule_changes(target_rule, rule_dict, diff)
                         # Changes have already been merged if any
                         if rule.get('add_after', None):
                             rule_at_pos = self.rule_by_tag(policy, rule.get('add_after'))
                             if rule_at_pos:
-                                target_rule.move_rule_after(rule_at_pos)
+                                target_rule = self.move(
+                                    target_rule, diff, after=rule.get('add_after'))
                                 changes.append('add_after')
                         elif rule.get('add_before', None):
                             rule_at_pos = self.rule_by_tag(policy, rule.get('add_before'))
                             if rule_at_pos:
-                                target_rule.move_rule_before(rule_at_pos)
+                                target_rule = self.move(
+                                    target_rule, diff, before=rule.get('add_before'))
                                 changes.append('add_before')
-                        elif changes:
+                        elif changes and not self.check_mode:
                             target_rule.save()
                         
                         if changes:
                             changed = True
-                            self.results['state'].append({
-                                'rule': target_rule.name,
-                                'type': target_rule.typeof,
-                                'action': 'modified',
-                                'changes': changes})
+                            self.record(target_rule, 'modified', changes, **diff)
     
             elif state == 'absent':
                 for rule in self.rules:
                     if 'tag' in rule:
                         target_rule = self.rule_by_tag(policy, rule.get('tag'))
                         if target_rule:
-                            target_rule.delete()
+                            position = self.position(target_rule)
+                            self.rule_index.delete(target_rule)
                             changed = True
-                            self.results['state'].append({
-                                'rule': target_rule.name,
-                                'type': target_rule.typeof,
-                                'action': 'deleted'})
+                            self.record(target_rule, 'deleted', before=dict(
+                                name=target_rule.name, position=position))
 
         except SMCException as err:
             self.fail(msg=str(err), exception=traceback.format_exc())
         
         self.results['changed'] = changed
+        if self.diff is not None:
+            self.results['diff'] = self.diff
         return self.results
     
+    def build_rule_dict(self, rule):
+        """
+        Build the rule create constructor arguments from the rule defined
+        in yaml. Referenced elements must already be in the cache.
+        
+        :param dict rule: firewall rule defined in yaml
+        :rtype: dict
+        """
+        rule_dict = {}
+
+        if 'log_options' in rule:
+            log_options = LogOptions()
+            log_options.update(rule.get('log_options', {}))
+            rule_dict.update(log_options=log_options)
+
+        if 'connection_tracking' in rule:
+            connection_tracking = ConnectionTracking()
+            _ct = rule['connection_tracking']
+            for name, value in connection_tracking.items():
+                if name not in _ct:
+                    connection_tracking.pop(name)
+
+            connection_tracking.update(rule.get('connection_tracking',{}))
+            rule_dict.update(connection_tracking=connection_tracking)
+
+        action = Action() # If no action, set to default based on version
+        if 'action' not in rule:
+            action.action = 'allow' if not is_sixdotsix_compat() else ['allow']
+        else:
+            action.action = rule.get('action')
+
+        if 'inspection_options' in rule:
+            _inspection = rule['inspection_options']
+            for option in inspection_options:
+                if option in _inspection:
+                    action[option] = _inspection.get(option)
+
+        if 'authentication_options' in rule:
+            _auth_options = rule['authentication_options']
+            auth_options = AuthenticationOptions()
+
+            if _auth_options.get('require_auth'):
+                auth_options.update(methods=[
+                    self.get_value('authentication_service', m).href
+                    for m in _auth_options.get('methods', [])],
+                require_auth=True)
+
+                auth_options.update(users=[
+                    self.cache.get_href('user_element', user)
+                    for accounts in ('users', 'groups')
+                    for user in _auth_options.get(accounts, [])])
+
+            rule_dict.update(authentication_options=auth_options)
+
+        rule_dict.update(action=action)
+
+        for field in ('sources', 'destinations', 'services'):
+            rule_dict[field] = self.get_values(rule.get(field, None))
+
+        rule_dict.update(
+            vpn_policy=self.get_value('vpn', rule.get('vpn_policy')),
+            sub_policy=self.get_value('sub_ipv4_fw_policy', rule.get('sub_policy')),
+            mobile_vpn=rule.get('mobile_vpn', False))
+
+        if 'comment' in rule:
+            rule_dict.update(comment=rule.get('comment'))
+
+        rule_dict.update(
+            name=rule.get('name'),
+            is_disabled=rule.get('is_disabled', False))
+        return rule_dict
+    
+    def replace_rules(self, rule_dicts):
+        """
+        Reconcile the policy with the full ordered list of rules. Rules are
+        matched to existing rules by tag, or by name when no tag is set.
+        A tag not found in the policy fails the module before any change.
+        Matched rules already in the wanted relative order are found with
+        a longest increasing subsequence of their current positions and
+        stay in place. Other matched rules are moved, existing rules not
+        in the list are deleted and unmatched rules are created. Only
+        rules with changes are saved.
+        
+        :param list rule_dicts: (rule, rule_dict) tuples in wanted order
+        :return: whether the policy was changed
+        :rtype: bool
+        """
+        current = list(self.rule_index.rules)
+        by_name = {}
+        for pos, rule in enumerate(current):
+            by_name.setdefault(rule.name, []).append(pos)
+        
+        matched = {} # desired index: current position
+        used = set()
+        for index, (rule, _rule_dict) in enumerate(rule_dicts):
+            if 'tag' in rule:
+                pos = self.rule_index.position(rule['tag'])
+                if not pos:
+                    self.fail(msg='Rule with tag %s was not found in policy %s. '
+                        'Remove the tag to create the rule as a new rule.'
+                        % (rule['tag'], self.policy or self.sub_policy))
+                pos -= 1
+            else:
+                pos = next((p for p in by_name.get(rule.get('name'), [])
+                            if p not in used), None)
+            if pos is not None and pos not in used:
+                matched[index] = pos
+                used.add(pos)
+        
+        order = sorted(matched)
+        stable = set(order[i] for i in longest_increasing_subsequence(
+            [matched[index] for index in order]))
+        
+        changed = False
+        for pos, rule in enumerate(current):
+            if pos not in used:
+                position = self.position(rule)
+                self.rule_index.delete(rule)
+                changed = True
+                self.record(rule, 'deleted', before=dict(
+                    name=rule.name, position=position))
+        
+        for index in sorted(stable):
+            rule = current[matched[index]]
+            diff = {}
+            changes = rule_changes(rule, rule_dicts[index][1], diff)
+            if changes:
+                if not self.check_mode:
+                    rule.save()
+                changed = True
+                self.record(rule, 'modified', changes, **diff)
+        
+        # Place each run of rules between rules staying in place. A run is
+        # inserted before the next stable rule, or in reverse order after
+        # the previous stable rule or at the top of the policy
+        index = 0
+        while index < len(rule_dicts):
+            if index in stable:
+                index += 1
+                continue
+            end = index
+            while end < len(rule_dicts) and end not in stable:
+                end += 1
+            run = range(index, end)
+            if end < len(rule_dicts):
+                anchor = dict(before=current[matched[end]].tag)
+            elif index:
+                anchor = dict(after=current[matched[index - 1]].tag)
+                run = reversed(run)
+            else:
+                anchor = {}
+                run = reversed(run)
+            
+            for num in run:
+                rule_dict = rule_dicts[num][1]
+                if num in matched:
+                    rule = current[matched[num]]
+                    diff = {}
+                    changes = rule_changes(rule, rule_dict, diff)
+                    rule = self.move(rule, diff, **anchor)
+                    self.record(rule, 'modified', changes + ['moved'], **diff)
+                else:
+                    rule = self.rule_index.create(**dict(
+                        rule_dict, after=anchor.get('after'), before=anchor.get('before')))
+                    self.record(rule, 'created', after=normalise_rule(None, rule_dict))
+                changed = True
+            index = end
+        
+        return changed
+    
     def rule_by_tag(self, policy, tag):
         """
         Get the rule referenced by it's tag. Tag will be in format
-        '1234566.0'. When doing a search_rule, you must omit the part
-        after the dot(.) to find the rule.
+        '1234566.0'. The revision part after the dot(.) is ignored.
+        Rules are found in the rule index of the policy, which lists
+        the policy rules once per run.
         
         :param FirewallPolicy policy: policy reference
         :param str tag: tag
         :rtype: Rule or None
         """
-        resolved_tag = get_tag(tag)
-        if resolved_tag:
-            rule = policy.search_rule('@{}'.format(resolved_tag))
-            return rule[0] if rule else None
+        if get_tag(tag):
+            return self.rule_index.get(tag)
     
     def field_resolver(self, elements, types):
         """
         Field resolver, specific to retrieving network or service level
         elements in different formats. If elements are referencing existing
-        elements, they will be loaded in the cache for retrieval.
+        elements, they are queued in `pending_elements` and loaded in the
+        cache for retrieval once all rules have been parsed.
         
         Format #1, as list (elements are expected to exist):
             - tcp_service:
@@ -1028,7 +1319,7 @@ class FirewallRule(ForcepointModuleBase):
                     self.fail(msg='Elements specified for type: %s should be in list '
                         'format, got: %s' % (name, type(value)))
             
-            self.cache.add_many([elements])
+            self.pending_elements.append(elements)
 
         elif isinstance(elements, list):
             for entry in elements:
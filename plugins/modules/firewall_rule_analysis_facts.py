@@ -0,0 +1,251 @@
+#!/usr/bin/python
+# Copyright (c) 2017-2019 Forcepoint
+
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+
+DOCUMENTATION = '''
+---
+module: firewall_rule_analysis_facts
+short_description: Find shadowed, redundant and correlated firewall rules
+description:
+  - Analyse the access rules of a firewall policy. Source and destination
+    cells are expanded into IP address ranges and service cells into
+    protocol and port ranges, groups being expanded recursively.
+  - A rule is shadowed when an earlier rule with a different action matches
+    all of its traffic, and redundant when the earlier rule has the same
+    action. Rules are correlated when they match common traffic with
+    different actions, without one containing the other.
+  - Elements that can not be expanded into ranges, like zones, aliases,
+    domain names or expressions, only match themselves. Disabled rules,
+    rule sections and rules with empty cells are not analysed. Rules with
+    the continue or jump actions, requiring authentication, or restricted
+    to source VPNs or validity times, never shadow later rules as they may
+    not match all the traffic of their cells.
+  - Rules are indexed with interval trees, so each rule is only compared
+    to the earlier rules it may overlap.
+
+version_added: '2.5'
+
+options:
+  filter:
+    description:
+      - The name of the Firewall Policy to analyse
+    required: true
+    type: str
+  correlated:
+    description:
+      - Also report correlated rules. Policies with many broad rules can
+        have a large number of correlations
+    type: bool
+    default: false
+  snapshot:
+    description:
+      - Path of a local snapshot of the policy rules. Later runs only fetch
+        the rules that are new or changed since the last run
+    type: str
+
+extends_documentation_fragment:
+  - management_center
+  - management_center_facts
+
+requirements:
+  - smc-python
+author:
+  - Forcepoint
+'''
+
+
+EXAMPLES = '''
+- name: Find shadowed and redundant rules in policy TestPolicy
+  firewall_rule_analysis_facts:
+    filter: TestPolicy
+
+- name: Also report correlated rules, reusing a snapshot of the rules
+  firewall_rule_analysis_facts:
+    filter: TestPolicy
+    correlated: true
+    snapshot: snapshots/TestPolicy_analysis.json
+'''
+
+
+RETURN = '''
+firewall_rule_analysis:
+    description: Shadowed, redundant and correlated rules of the policy.
+        Positions start at 1 and include rule sections
+    returned: always
+    type: dict
+    sample: {
+        "policy": "TestPolicy",
+        "rules": 4,
+        "opaque_elements": 1,
+        "shadowed": [
+            {
+                "action": "allow",
+                "name": "ruletest",
+                "pos": 4,
+                "tag": "2097168.0",
+                "by": {
+                    "action": "discard",
+                    "name": "Rule @2097166.2",
+                    "pos": 1,
+                    "tag": "2097166.2"
+                }
+            }
+        ],
+        "redundant": [],
+        "correlated": []
+    }
+'''
+import traceback
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_util import \
+    ForcepointModuleBase
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_rule_analysis import \
+    ElementRanges, CellIndex, cells, non_terminating, policy_records, reference
+
+try:
+    from smc.api.exceptions import SMCException
+    from smc.policy.layer3 import FirewallPolicy
+except ImportError:
+    pass
+
+
+def analyse(records, ranges, correlated=False):
+    """
+    Find shadowed, redundant and correlated rules.
+
+    Rules able to shadow later rules are indexed per cell. For each rule,
+    the rules whose cells may cover, or overlap, all of its cells are the
+    intersection of the candidates returned by each cell index. Only
+    those earlier candidates are compared to the rule.
+
+    :param list records: rule records in policy order
+    :param ElementRanges ranges: expands cells into ranges
+    :param bool correlated: also find correlated rules
+    :rtype: dict
+    """
+    rules = []
+    for pos, record in enumerate(records, 1):
+        if record.get('is_disabled') or not all(record.get(cell) for cell in cells):
+            continue
+        space = tuple(ranges.cell(record[cell]) for cell in cells)
+        if any(cell.is_none for cell in space):
+            continue
+        rules.append(dict(
+            pos=pos,
+            name=record['name'],
+            tag=record['tag'],
+            action=record['action'],
+            space=space,
+            terminating=record['action'] not in non_terminating and
+                not record.get('require_auth') and not record.get('conditions')))
+
+    shadowing = [(num, rule) for num, rule in enumerate(rules) if rule['terminating']]
+    indexes = [CellIndex((num, rule['space'][dim]) for num, rule in shadowing)
+               for dim in range(len(cells))]
+
+    result = dict(shadowed=[], redundant=[], correlated=[])
+    for num, rule in enumerate(rules):
+        space = rule['space']
+        candidates = None
+        for dim, index in enumerate(indexes):
+            keys = index.covering(space[dim])
+            candidates = keys if candidates is None else candidates & keys
+            if not candidates:
+                break
+        covering = sorted(key for key in candidates or () if key < num and
+            all(rules[key]['space'][dim].covers(space[dim]) for dim in range(len(cells))))
+        if covering:
+            by = rules[covering[0]]
+            entry = dict(reference(rule), by=reference(by))
+            if by['action'] == rule['action']:
+                result['redundant'].append(entry)
+            else:
+                result['shadowed'].append(entry)
+            continue
+
+        if correlated:
+            candidates = None
+            for dim, index in enumerate(indexes):
+                keys = index.overlapping(space[dim])
+                if keys is None:
+                    continue
+                candidates = keys if candidates is None else candidates & keys
+            if candidates is None:
+                candidates = [key for key, _rule in shadowing if key < num]
+            related = [rules[key] for key in sorted(candidates) if key < num and
+                rules[key]['action'] != rule['action'] and
+                all(rules[key]['space'][dim].overlaps(space[dim]) for dim in range(len(cells))) and
+                not all(space[dim].covers(rules[key]['space'][dim]) for dim in range(len(cells)))]
+            if related:
+                result['correlated'].append(dict(
+                    reference(rule), rules=[reference(other) for other in related]))
+
+    result.update(
+        rules=len(rules),
+        opaque_elements=len(set(href for rule in rules for cell in rule['space']
+                                for href in cell.opaque)))
+    return result
+
+
+class FirewallRuleAnalysisFacts(ForcepointModuleBase):
+    def __init__(self):
+
+        self.module_args = dict(
+            filter=dict(type='str', required=True),
+            correlated=dict(type='bool', default=False),
+            snapshot=dict(type='str')
+        )
+
+        self.filter = None
+        self.limit = None
+        self.exact_match = None
+        self.case_sensitive = None
+        self.correlated = None
+        self.snapshot = None
+
+        self.results = dict(
+            ansible_facts=dict(
+                firewall_rule_analysis={}
+            )
+        )
+        super(FirewallRuleAnalysisFacts, self).__init__(self.module_args, is_fact=True)
+
+    def exec_module(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+        try:
+            policy = self.search_by_type(FirewallPolicy)
+            if not policy:
+                self.fail(msg='Policy specified could not be found: %s' % self.filter)
+            elif len(policy) > 1:
+                self.fail(msg='Multiple policies found with the given search filter: %s '
+                    'Use exact_match or case_sensitive to narrow the search' %
+                    [p.name for p in policy])
+
+            policy = policy.pop()
+            records = policy_records(policy.fw_ipv4_access_rules, self.snapshot)
+            analysis = analyse(records, ElementRanges(), self.correlated)
+
+        except SMCException as err:
+            self.fail(msg=str(err), exception=traceback.format_exc())
+        except (IOError, OSError) as err:
+            self.fail(msg='Failed to update the snapshot file: %s' % err,
+                exception=traceback.format_exc())
+
+        analysis.update(policy=policy.name)
+        self.results['ansible_facts']['firewall_rule_analysis'] = analysis
+        return self.results
+
+
+def main():
+    FirewallRuleAnalysisFacts()
+
+if __name__ == '__main__':
+    main()
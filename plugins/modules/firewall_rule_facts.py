@@ -38,6 +38,8 @@ options:
     description:
       - Provide a rule range to retrieve. Firewall rules will be displayed based
         on the ranges provided in a top down fashion.
+        Only the rules within the range are fetched, in pages of I(page_size)
+        rules when set.
     type: str
   expand:
     description:
@@ -57,6 +59,33 @@ options:
         also use the provided jinja templates to format into yaml and reuse for playbook
         runs.
     type: bool
+  output_file:
+    description:
+      - Path of a file to write the rules to, in the format of I(as_yaml).
+        Rules are written as they are fetched and only a summary with the
+        path and number of rules written is returned in the facts. Use for
+        large policies, where returning all rules in the facts would use
+        too much memory.
+    type: str
+  snapshot:
+    description:
+      - Path of a local snapshot of the policy rules, created on the first
+        run. Later runs only fetch and serialise rules that are new or
+        whose revision changed, reuse the snapshot for the others and drop
+        deleted rules. Rules are returned in the format of I(as_yaml), or
+        written to I(output_file). Expanded element names are the names
+        when the rule was last fetched. Mutually exclusive with I(search)
+        and I(rule_range)
+    type: str
+  output_format:
+    description:
+      - Format of I(output_file). C(jsonl) writes a JSON document per line,
+        C(yaml) writes a yaml list of rules
+    choices:
+      - jsonl
+      - yaml
+    default: jsonl
+    type: str
   
 extends_documentation_fragment:
   - management_center
@@ -98,6 +127,21 @@ EXAMPLES = '''
       - destinations
       - services
 
+  - name: Export all rules with expanded fields to a JSON lines file
+    firewall_rule_facts:
+      filter: TestPolicy
+      output_file: TestPolicy.jsonl
+      expand:
+      - sources
+      - destinations
+      - services
+
+  - name: Nightly backup of the policy, refetching changed rules only
+    firewall_rule_facts:
+      filter: TestPolicy
+      snapshot: snapshots/TestPolicy.json
+      output_file: backups/TestPolicy.jsonl
+
   - name: Get specific rules based on range order (rules 1-10)
     firewall_rule_facts:
       filter: TestPolicy
@@ -160,7 +204,8 @@ firewall_rule:
     }]
 '''
 import traceback
-from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_util import ForcepointModuleBase
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_util import ForcepointModuleBase, \
+    iter_rule_range, iter_yaml, HrefResolver, RecordWriter, RuleSnapshot, HAS_YAML
 
 try:
     from smc.api.exceptions import SMCException
@@ -173,7 +218,17 @@ engine_type = ('single_fw', 'single_layer2', 'single_ips', 'virtual_fw',
     'fw_cluster', 'master_engine')
 
 
-def to_yaml(rule, expand=None):
+def to_yaml(rule, expand=None, resolver=None):
+    """
+    Rule as a dict, in the format of the rule module. Elements of the
+    expanded fields are resolved through the resolver.
+
+    :param rule: rule fetched from the policy
+    :param list expand: fields to expand into element types and names
+    :param HrefResolver resolver: resolver shared by the rules
+    :rtype: dict
+    """
+    resolver = resolver or HrefResolver()
     _rule = {
         'name': rule.name, 'tag': rule.tag,
         'is_disabled': rule.is_disabled,
@@ -190,14 +245,13 @@ def to_yaml(rule, expand=None):
         else:
             if expand and field in expand:
                 tmp = {}
-                for entry in getattr(rule, field).all():
-                    element_type = entry.typeof
-                    if entry.typeof in engine_type:
+                for href in getattr(rule, field).all_as_href():
+                    element_type, name = resolver.get(href)
+                    if element_type in engine_type:
                         element_type = 'engine'
-                    elif 'alias' in entry.typeof:
+                    elif 'alias' in element_type:
                         element_type = 'alias'
-                    tmp.setdefault(element_type, []).append(
-                        entry.name)
+                    tmp.setdefault(element_type, []).append(name)
             else:
                 tmp = getattr(rule, field).all_as_href()
             _rule[field] = tmp
@@ -243,7 +297,10 @@ class FirewallRuleFacts(ForcepointModuleBase):
             filter=dict(type='str', required=True),
             expand=dict(type='list', default=[]),
             search=dict(type='str'),
-            rule_range=dict(type='str')
+            rule_range=dict(type='str'),
+            output_file=dict(type='str'),
+            snapshot=dict(type='str'),
+            output_format=dict(type='str', default='jsonl', choices=['jsonl', 'yaml'])
         )
     
         self.expand = None
@@ -253,9 +310,12 @@ class FirewallRuleFacts(ForcepointModuleBase):
         self.as_yaml = None
         self.exact_match = None
         self.case_sensitive = None
+        self.output_file = None
+        self.snapshot = None
+        self.output_format = None
         
         mutually_exclusive = [
-            ['search', 'rule_range'],
+            ['search', 'rule_range', 'snapshot'],
         ]
         
         self.results = dict(
@@ -275,7 +335,11 @@ class FirewallRuleFacts(ForcepointModuleBase):
                 self.fail(msg='Invalid expandable attribute: %s provided. Valid '
                     'options are: %s'  % (attr, expands))
         
+        if self.output_file and self.output_format == 'yaml' and not HAS_YAML:
+            self.fail(msg='PyYAML is required to write the output file as yaml')
+        
         rules = []
+        output = None
         try:
             policy = self.search_by_type(FirewallPolicy)
             if not policy:
@@ -292,17 +356,40 @@ class FirewallRuleFacts(ForcepointModuleBase):
             elif self.rule_range:
                 try:
                     start, end = map(int, self.rule_range.split('-'))
-                    result= [x for x in policy.fw_ipv4_access_rules][start-1:end]
                 except ValueError:
                     raise SMCException('Value of rule range was invalid. Rule ranges '
                         'must be a string with numeric only values, got: %s' %
                         self.rule_range)
+                if start < 1 or end < start:
+                    raise SMCException('Value of rule range was invalid. Rule ranges '
+                        'must start at 1 and end after the start, got: %s' %
+                        self.rule_range)
+                # Only the rules within the range are fetched
+                result = list(iter_rule_range(
+                    policy.fw_ipv4_access_rules, start, end, self.page_size))
             else:
                 result = policy.fw_ipv4_access_rules
             
-            if self.as_yaml:
-                rules = [to_yaml(rule, self.expand) for rule in result
-                         if rule.typeof == 'fw_ipv4_access_rule']
+            records = None
+            if self.snapshot:
+                # Only new and changed rules are fetched and serialised
+                snapshot = RuleSnapshot(self.snapshot, policy.fw_ipv4_access_rules,
+                    variant=','.join(sorted(self.expand)))
+                records = snapshot.refresh(
+                    [rule for rule in result if rule.typeof == 'fw_ipv4_access_rule'],
+                    lambda changed: iter_yaml(changed, to_yaml, 'fw_ipv4_access_rule', self.expand))
+            elif self.output_file or self.as_yaml:
+                records = iter_yaml(result, to_yaml, 'fw_ipv4_access_rule', self.expand)
+            
+            if self.output_file:
+                # Rules are written as they are fetched, only a summary
+                # is returned
+                with RecordWriter(self.output_file, self.output_format) as writer:
+                    for rule in records:
+                        writer.write(rule)
+                output = dict(path=writer.path, format=writer.fmt, rules=writer.count)
+            elif records is not None:
+                rules = list(records)
             else:
                 # No order for since rules could be sliced or searched
                 if self.search or self.rule_range:
@@ -313,10 +400,17 @@ class FirewallRuleFacts(ForcepointModuleBase):
         
         except SMCException as err:
             self.fail(msg=str(err), exception=traceback.format_exc())
+        except (IOError, OSError) as err:
+            self.fail(msg='Failed to write rules to output file: %s' % err,
+                exception=traceback.format_exc())
         
         firewall_rule = {
             'policy': policy.name,
             'rules': rules}
+        if output:
+            firewall_rule.update(output_file=output)
+        if self.snapshot:
+            firewall_rule.update(snapshot=snapshot.summary())
     
         self.results['ansible_facts']['firewall_rule'].append(firewall_rule)
         return self.results
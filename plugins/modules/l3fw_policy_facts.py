@@ -121,7 +121,7 @@ class FWPolicyFacts(ForcepointModuleBase):
         for name, value in kwargs.items():
             setattr(self, name, value)
         
-        result = self.search_by_type(FirewallPolicy)
+        result = self.iter_by_type(FirewallPolicy)
         # Search by specific element type
         if self.filter:    
             elements = [policy_dict_from_obj(element) for element in result]
@@ -171,10 +171,10 @@ class NetworkElementFacts(ForcepointModuleBase):
         
         # Search by specific element type
         if self.element:
-            result = self.search_by_type(ELEMENT_TYPES.get(self.element)['type'])
+            result = self.iter_by_type(ELEMENT_TYPES.get(self.element)['type'])
         else:
             self.element = 'network_elements'
-            result = self.search_by_context()
+            result = self.iter_by_context()
         
         if self.filter:
             elements = [element_dict_from_obj(element, ELEMENT_TYPES, self.expand) for element in result]
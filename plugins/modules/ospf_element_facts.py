@@ -248,7 +248,7 @@ class OSPFElementFacts(ForcepointModuleBase):
         for name, value in kwargs.items():
             setattr(self, name, value)
         
-        result = self.search_by_type(lookup_class(self.element))
+        result = self.iter_by_type(lookup_class(self.element))
         if self.filter:
             if self.as_yaml:
                 elements = [convert_to_dict(element) for element in result
@@ -210,7 +210,7 @@ class PolicyVPNFacts(ForcepointModuleBase):
                 self.fail(msg='Expandable attributes should be in string format, got: {}'.format(
                     type(specified)))
 
-        result = self.search_by_type(PolicyVPN)
+        result = self.iter_by_type(PolicyVPN)
         # Search by specific element type
         if self.filter:    
             elements = [to_dict(element, self.expand) for element in result]
@@ -183,7 +183,7 @@ class RouteMapFacts(ForcepointModuleBase):
         for name, value in kwargs.items():
             setattr(self, name, value)
         
-        result = self.search_by_type(RouteMap)
+        result = self.iter_by_type(RouteMap)
         if self.filter:
             if self.as_yaml:
                 route_maps = [to_yaml(rm) for rm in result
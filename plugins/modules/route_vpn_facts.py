@@ -367,7 +367,7 @@ class RouteVPNFacts(ForcepointModuleBase):
                 self.fail(msg='Invalid expandable attribute provided: {}. Valid options '
                     'are {}'.format(attr, expands))
             
-        result = self.search_by_type(RouteVPN)
+        result = self.iter_by_type(RouteVPN)
         # Search by specific element type
         if self.filter:
             if self.as_yaml:
@@ -0,0 +1,349 @@
+#!/usr/bin/python
+# Copyright (c) 2017-2019 Forcepoint
+
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+
+DOCUMENTATION = '''
+---
+module: rule_usage_facts
+short_description: Find the rules referencing elements
+description:
+  - Build an index of the elements referenced by the access and NAT rules
+    of one or more firewall policies or sub-policies, and return the rules
+    referencing the specified elements. Use before deleting or modifying
+    an element to see the rules it would impact.
+  - The index maps the href of each element referenced in a source,
+    destination or service cell, in the translated or original value of a
+    NAT rule, or as the engine a NAT rule is used on, to the rules
+    referencing it. Rules referencing a group that contains an element, at
+    any depth, are also returned with the name of the group. Each group
+    referenced by the rules is fetched once per run.
+  - When I(index_file) is set, the rule references are persisted locally
+    and later runs only fetch the rules that are new or changed since the
+    last run. Each run still lists all rules of the policies and checks
+    each indexed rule with a conditional request on its etag.
+
+version_added: '2.5'
+
+options:
+  policies:
+    description:
+      - Names of the firewall policies to index
+    type: list
+  sub_policies:
+    description:
+      - Names of the firewall sub-policies to index
+    type: list
+  elements:
+    description:
+      - Elements to find the rules for. Elements are specified by their
+        type and name, the same way as in rule cells, for example
+        C(host), C(network), C(tcp_service) or C(engine)
+    type: dict
+  index_file:
+    description:
+      - Path of the local index file. The index is created on the first run
+        and refreshed incrementally on later runs. Without an index file,
+        all rules of the policies are fetched
+    type: str
+
+extends_documentation_fragment:
+  - management_center
+
+requirements:
+  - smc-python
+author:
+  - Forcepoint
+'''
+
+
+EXAMPLES = '''
+- name: Find the rules using a host and a service before deleting them
+  rule_usage_facts:
+    policies:
+    - TestPolicy
+    - OtherPolicy
+    sub_policies:
+    - MySubPolicy
+    index_file: ~/.ansible/smc_rule_usage.json
+    elements:
+      host:
+      - hostA
+      tcp_service:
+      - HTTP
+'''
+
+
+RETURN = '''
+rule_usage:
+    description: Rules referencing each element
+    returned: always
+    type: list
+    sample: [
+    {
+        "href": "https://172.18.1.150:8082/6.5/elements/host/978",
+        "name": "hostA",
+        "type": "host",
+        "rules": [
+            {
+                "cell": "sources",
+                "policy": "TestPolicy",
+                "rule": "ruletest",
+                "tag": "2097166.2",
+                "type": "fw_ipv4_access_rule"
+            },
+            {
+                "cell": "destinations",
+                "group": "servers",
+                "policy": "TestPolicy",
+                "rule": "servertest",
+                "tag": "2097167.1",
+                "type": "fw_ipv4_access_rule"
+            }
+        ]
+    }]
+rule_index:
+    description: Summary of the index per policy and rule type, with the
+        rules added, changed and deleted since the last run when an index
+        file is used
+    returned: always
+    type: list
+'''
+import traceback
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_util import \
+    ForcepointModuleBase, Cache, RuleSnapshot, HrefResolver
+from ansible_collections.forcepoint.fp_ngfw_smc_ansible.plugins.module_utils.smc_rule_analysis import \
+    nat_types
+
+try:
+    from smc.policy.layer3 import FirewallPolicy, FirewallSubPolicy
+    from smc.api.exceptions import SMCException
+    from smc.base.model import Element
+except ImportError:
+    pass
+
+
+cells = ('sources', 'destinations', 'services')
+
+
+def nat_references(options):
+    """
+    Elements referenced by the translated and original values of a NAT
+    type of a rule
+
+    :param dict options: NAT type options of the rule
+    :rtype: list
+    """
+    values = list(options.get('translation_values') or []) + \
+        [options.get('translated_value'), options.get('original_value')]
+    return [value['element'] for value in values if value and value.get('element')]
+
+
+def rule_cells(rules):
+    """
+    Referenced elements of the rules, as the hrefs in each rule cell, in
+    the NAT translations and in the used on field of NAT rules. The data
+    of a rule is released once its cells are read.
+
+    :param list rules: rules fetched from a policy
+    :return: generator of dict with the rule name, tag and cells
+    """
+    for rule in rules:
+        record = {'name': rule.name, 'tag': rule.tag, 'cells': {}}
+        if not rule.is_rule_section:
+            for cell in cells:
+                hrefs = getattr(rule, cell).all_as_href()
+                if hrefs:
+                    record['cells'][cell] = hrefs
+            options = rule.data.get('options') or {}
+            for nat_type in nat_types:
+                hrefs = nat_references(options.get(nat_type) or {})
+                if hrefs:
+                    record['cells'][nat_type] = hrefs
+            # Used on any engine is a dict, an engine is its href
+            used_on = rule.data.get('used_on')
+            if used_on and not isinstance(used_on, dict):
+                record['cells']['used_on'] = [used_on]
+        yield record
+        del rule.data
+
+
+def is_group(href):
+    typeof = HrefResolver.typeof(href) or ''
+    return typeof == 'group' or typeof.endswith('_group')
+
+
+def group_members(groups):
+    """
+    Members of groups at any depth. Each group, including nested groups,
+    is fetched once.
+
+    :param list groups: hrefs of groups
+    :return: dict of group href to the group name and the hrefs of its
+        members at any depth
+    :rtype: dict
+    """
+    loaded = {} # href: (name, direct members)
+
+    def load(href):
+        if href not in loaded:
+            element = Element.from_href(href)
+            loaded[href] = (element.name, element.data.get('element') or [])
+        return loaded[href]
+
+    result = {}
+    for href in groups:
+        members, pending = set(), [href]
+        while pending:
+            for member in load(pending.pop())[1]:
+                if member not in members:
+                    members.add(member)
+                    if is_group(member):
+                        pending.append(member)
+        result[href] = (load(href)[0], members)
+    return result
+
+
+def policy_rules(policy):
+    """
+    Rule collections of a policy to index
+
+    :rtype: list
+    """
+    collections = [policy.fw_ipv4_access_rules]
+    if hasattr(policy, 'fw_ipv4_nat_rules'):
+        collections.append(policy.fw_ipv4_nat_rules)
+    return collections
+
+
+class RuleUsageFacts(ForcepointModuleBase):
+    def __init__(self):
+
+        self.module_args = dict(
+            policies=dict(type='list', default=[]),
+            sub_policies=dict(type='list', default=[]),
+            elements=dict(type='dict', default={}),
+            index_file=dict(type='str')
+        )
+
+        self.policies = None
+        self.sub_policies = None
+        self.elements = None
+        self.index_file = None
+
+        required_one_of = [
+            ['policies', 'sub_policies']
+        ]
+
+        self.results = dict(
+            ansible_facts=dict(
+                rule_usage=[],
+                rule_index=[]
+            )
+        )
+        super(RuleUsageFacts, self).__init__(self.module_args,
+            required_one_of=required_one_of)
+
+    def exec_module(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+        for typeof, names in self.elements.items():
+            if not isinstance(names, list):
+                self.fail(msg='Elements must be specified as a list of names '
+                    'for each type, got: %s' % {typeof: names})
+
+        try:
+            cache = Cache()
+            cache.add(self.elements)
+            if cache.missing:
+                self.fail(msg='Missing elements that were specified: %s'
+                    % cache.missing)
+
+            policies = [FirewallPolicy.get(name) for name in self.policies] + \
+                [FirewallSubPolicy.get(name) for name in self.sub_policies]
+
+            # Only the references to the specified elements are kept
+            index = {href: [] for href in (
+                cache.get_href(typeof, name)
+                for typeof, names in self.elements.items() for name in names)}
+            groups = {} # group href: rules referencing the group
+            for policy in policies:
+                for collection in policy_rules(policy):
+                    for rule_type, record in self.iter_records(policy, collection):
+                        for cell, hrefs in record['cells'].items():
+                            for href in hrefs:
+                                if href in index or is_group(href):
+                                    reference = dict(
+                                        policy=policy.name,
+                                        rule=record['name'],
+                                        tag=record['tag'],
+                                        type=rule_type,
+                                        cell=cell)
+                                    if href in index:
+                                        index[href].append(reference)
+                                    if is_group(href):
+                                        groups.setdefault(href, []).append(reference)
+
+            # Rules referencing the elements through groups
+            for group, (name, members) in group_members(groups).items():
+                for href in members.intersection(index):
+                    index[href].extend(dict(reference, group=name)
+                                       for reference in groups[group])
+
+            for typeof, names in self.elements.items():
+                for name in names:
+                    href = cache.get_href(typeof, name)
+                    self.results['ansible_facts']['rule_usage'].append(dict(
+                        type=typeof,
+                        name=name,
+                        href=href,
+                        rules=index[href]))
+
+        except SMCException as err:
+            self.fail(msg=str(err), exception=traceback.format_exc())
+        except (IOError, OSError) as err:
+            self.fail(msg='Failed to update the index file: %s' % err,
+                exception=traceback.format_exc())
+
+        return self.results
+
+    def iter_records(self, policy, collection):
+        """
+        Referenced elements of the rules of a collection, refreshed from
+        the index file when one is used. A summary of the collection is
+        added to the results.
+
+        :param Policy policy: policy of the rules
+        :param rule_collection collection: rules of the policy
+        :return: generator of (rule type, record) tuples
+        """
+        rule_type = collection.cls.typeof
+        rules = [rule for rule in collection if rule.typeof == rule_type]
+        summary = dict(policy=policy.name, type=rule_type, rules=len(rules))
+
+        if self.index_file:
+            snapshot = RuleSnapshot(self.index_file, collection, variant='references')
+            records = snapshot.refresh(rules, rule_cells)
+            snapshot_summary = snapshot.summary()
+            snapshot_summary.pop('path')
+            summary.update(snapshot_summary)
+        else:
+            records = rule_cells(rules)
+
+        self.results['ansible_facts']['rule_index'].append(summary)
+        for record in records:
+            yield rule_type, record
+
+
+def main():
+    RuleUsageFacts()
+
+if __name__ == '__main__':
+    main()